@@ -0,0 +1,129 @@
+import asyncio
+import os
+import time
+
+from collections import namedtuple
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Multiplies every route's rate and burst; 0 turns rate limiting off.
+RATE_LIMIT_SCALE = float(os.getenv('RATE_LIMIT_SCALE', 1.0))
+# Sheddable routes are refused while the event loop lags more than this
+# many seconds; 0 turns shedding off.
+LOOP_LAG_THRESHOLD = float(os.getenv('LOOP_LAG_THRESHOLD', 0.1))
+LOOP_LAG_INTERVAL = float(os.getenv('LOOP_LAG_INTERVAL', 0.05))
+SHED_RETRY_AFTER = float(os.getenv('SHED_RETRY_AFTER', 1.0))
+
+# Requests per second and burst allowed per connection and per user,
+# whether the route is refused while the server is overloaded, and whether
+# it sends a response. Clients pairing responses with requests would take a
+# refusal of a route without one for another request's answer, so such a
+# route is admitted over its limit and only counted.
+Limit = namedtuple('Limit', ('rate', 'burst', 'shed', 'responds'),
+                   defaults=(False, True))
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate: float, burst: float, now: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def refill(self, now: float):
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, now: float) -> float:
+        """Take a token; return 0, or the seconds until one is available."""
+        self.refill(now)
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class Admission:
+    """Token buckets per connection and per user for each limited route,
+    and shedding of expensive routes while the event loop lags.
+
+    ``admit`` returns None for an admitted request, otherwise the response
+    refusing it with the seconds after which a retry may succeed.
+    """
+
+    def __init__(self, limits: dict, scale=RATE_LIMIT_SCALE,
+                 lag_threshold=LOOP_LAG_THRESHOLD,
+                 retry_after=SHED_RETRY_AFTER):
+        self.limits = {route: Limit(limit.rate * scale, limit.burst * scale,
+                                    limit.shed, limit.responds)
+                       for route, limit in limits.items()}
+        self.scale = scale
+        self.lag_threshold = lag_threshold
+        self.retry_after = retry_after
+        # (addr or user_id, route) -> TokenBucket.
+        self.connection_buckets = {}
+        self.user_buckets = {}
+        self.pruned_size = 1024
+        self.lag = 0.0
+        self.throttled = 0
+        self.shed = 0
+        # Requests over the limit of a route without responses, admitted.
+        self.over_limit = 0
+
+    def _take(self, buckets: dict, key, limit: Limit, now: float) -> float:
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(limit.rate, limit.burst, now)
+        return bucket.take(now)
+
+    def admit(self, route: str, addr: str, user_id: str = None):
+        limit = self.limits.get(route)
+        if limit is None:
+            return None
+        if limit.shed and self.lag_threshold and \
+                self.lag > self.lag_threshold:
+            self.shed += 1
+            return {'status': 'busy', 'route': route,
+                    'retry_after': self.retry_after}
+        if not self.scale:
+            return None
+        now = time.monotonic()
+        wait = self._take(self.connection_buckets, (addr, route), limit, now)
+        if not wait and user_id is not None:
+            wait = self._take(self.user_buckets, (user_id, route), limit, now)
+            if len(self.user_buckets) > self.pruned_size:
+                self.prune(now)
+        if not wait:
+            return None
+        if not limit.responds:
+            self.over_limit += 1
+            return None
+        self.throttled += 1
+        return {'status': 'rate limited', 'route': route,
+                'retry_after': round(wait, 3)}
+
+    def prune(self, now: float):
+        # A full bucket is the same as none.
+        for key, bucket in list(self.user_buckets.items()):
+            bucket.refill(now)
+            if bucket.tokens >= bucket.burst:
+                del self.user_buckets[key]
+        self.pruned_size = max(2 * len(self.user_buckets), 1024)
+
+    def forget(self, addr: str):
+        for route in self.limits:
+            self.connection_buckets.pop((addr, route), None)
+
+    async def monitor_lag(self, interval=LOOP_LAG_INTERVAL):
+        # How late a sleep wakes up is how long ready callbacks wait for
+        # the loop; a spike decays over a few intervals instead of being
+        # forgotten at the next quiet sample.
+        while True:
+            started = time.monotonic()
+            await asyncio.sleep(interval)
+            late = time.monotonic() - started - interval
+            self.lag = max(late, self.lag / 2)
@@ -0,0 +1,136 @@
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from datetime import datetime, timedelta
+
+POPULATE_BATCH = 100000
+SIZES = {'k': 1000, 'm': 1000000}
+
+
+def parse_size(size: str) -> int:
+    size = size.lower()
+    if size[-1] in SIZES:
+        return int(float(size[:-1]) * SIZES[size[-1]])
+    return int(size)
+
+
+def measure(function, repeat: int) -> dict:
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        function()
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return {'repeat': repeat,
+            'mean_us': round(sum(samples) / repeat * 1e6, 2),
+            'p50_us': round(samples[repeat // 2] * 1e6, 2),
+            'p99_us': round(samples[min(int(repeat * 0.99), repeat - 1)]
+                            * 1e6, 2)}
+
+
+def populate(mm, chat_id: str, size: int):
+    start = datetime(2024, 1, 1)
+    for first in range(mm.storage.count(chat_id), size, POPULATE_BATCH):
+        mm.storage.append(chat_id, [
+            [(start + timedelta(milliseconds=seq)).isoformat(),
+             f'user_{seq % 1000}', f'benchmark message {seq}']
+            for seq in range(first, min(first + POPULATE_BATCH, size))])
+    mm.storage.sync([chat_id])
+    return start
+
+
+def run(mm, size: int, repeat: int) -> dict:
+    chat_id = f'bench_{size}'
+    started = time.perf_counter()
+    start = populate(mm, chat_id, size)
+    populated = time.perf_counter() - started
+    reader = 'bench_reader'
+    mm.storage.ack_upto(chat_id, reader, max(size - 100, 0))
+    recent = '/'.join((start + timedelta(milliseconds=seq)).isoformat()
+                      for seq in range(max(size - 20, 0), size))
+    middle = (start + timedelta(milliseconds=size // 2)).isoformat()
+    started = time.perf_counter()
+    # Indexes the populated chat up front rather than in the background.
+    with mm.lock:
+        search_index = mm.search_indexes.open(chat_id)
+        search_index.catch_up(mm.storage.count(chat_id))
+    search_index.flush()
+    while search_index.merge():
+        pass
+    indexed = time.perf_counter() - started
+
+    def latest_cold():
+        mm.history_cache.drop(chat_id)
+        mm.get_latest_messages(chat_id)
+
+    results = {
+        'get_latest_messages_cold': measure(latest_cold, repeat),
+        'get_latest_messages': measure(
+            lambda: mm.get_latest_messages(chat_id), repeat),
+        'get_unread_page': measure(
+            lambda: mm.get_unread_page(reader, chat_id, 50), repeat),
+        'get_history_page': measure(
+            lambda: mm.get_history_page(chat_id, middle, None, 50), repeat),
+        'search_messages': measure(
+            lambda: mm.search_messages(chat_id, f'message {size // 2}', 50),
+            repeat),
+        'search_messages_common': measure(
+            lambda: mm.search_messages(chat_id, 'benchmark message', 50),
+            repeat),
+        'update_message_status': measure(
+            lambda: mm.update_message_status(recent, 'bench_acker', chat_id),
+            repeat),
+        'save_message_to_csv': measure(
+            lambda: mm.save_message_to_csv('benchmark', 'bench', chat_id),
+            repeat),
+    }
+    return {'size': size,
+            'populate_seconds': round(populated, 3),
+            'search_index_seconds': round(indexed, 3),
+            'functions': results}
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Micro-benchmarks of messages_manager on chats of '
+                    'increasing size.')
+    parser.add_argument('--sizes', nargs='+', default=['10k', '1m', '10m'])
+    parser.add_argument('--repeat', type=int, default=200)
+    parser.add_argument('--chat-log-dir',
+                        help='reuse a populated directory between runs')
+    parser.add_argument('--backend', choices=('csv', 'sqlite'),
+                        help='storage backend (default: STORAGE_BACKEND)')
+    parser.add_argument('--output', help='write the results as JSON here')
+    args = parser.parse_args()
+
+    chat_log_dir = args.chat_log_dir or tempfile.mkdtemp(
+        prefix='messanger-bench-')
+    os.environ['CHAT_LOG_DIR'] = chat_log_dir
+    if args.backend:
+        os.environ['STORAGE_BACKEND'] = args.backend
+    import messages_manager as mm
+
+    results = []
+    try:
+        for size in map(parse_size, args.sizes):
+            results.append(run(mm, size, args.repeat))
+            print(json.dumps(results[-1]), flush=True)
+    finally:
+        mm.close()
+        if not args.chat_log_dir:
+            shutil.rmtree(chat_log_dir, ignore_errors=True)
+
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump({'created': time.time(),
+                       'python': sys.version.split()[0],
+                       'results': results}, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
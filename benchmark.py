@@ -0,0 +1,315 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from collections import deque
+from dotenv import load_dotenv
+from multiprocessing import Pool
+
+from protocol import HEADER, encode_frame
+
+load_dotenv()
+
+HOST = os.getenv('HOST') or '127.0.0.1'
+PORT = int(os.getenv('PORT') or 5000)
+BENCHMARK_PORT = int(os.getenv('BENCHMARK_PORT', 5999))
+
+ROUTES = ('connect', 'send', 'send_private', 'unread', 'read', 'status',
+          'history', 'read_upto', 'search')
+DEFAULT_MIX = 'send=2,unread=2,read=2,status=4'
+QUANTILES = {'p50': 0.5, 'p99': 0.99, 'p999': 0.999}
+BROADCAST_MARKER = 'bench:'
+
+
+def parse_mix(mix: str) -> dict:
+    weights = {}
+    for item in mix.split(','):
+        route, _, weight = item.partition('=')
+        if route not in ROUTES:
+            raise argparse.ArgumentTypeError(f'Unknown route {route!r}.')
+        weights[route] = float(weight or 1)
+    return weights
+
+
+class Connection:
+    """One benchmark client: matches responses to requests in order and
+    measures the lag of broadcasts sent by any benchmark client."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.reader = None
+        self.writer = None
+        self.listener = None
+        self.user_id = ''
+        self.pending = deque()
+        self.last_seq = None
+
+    async def open(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.listener = asyncio.create_task(self.listen())
+        response = await self.request('connect', 'POST /connect')
+        self.user_id = response['user_id']
+
+    async def listen(self):
+        try:
+            while True:
+                header = await self.reader.readexactly(HEADER.size)
+                payload = await self.reader.readexactly(
+                    HEADER.unpack(header)[0])
+                self.dispatch(payload)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            for future in self.pending:
+                if not future.done():
+                    future.set_exception(ConnectionError('closed'))
+
+    def dispatch(self, payload: bytes):
+        try:
+            response = json.loads(payload)
+        except ValueError:
+            response = {'status': payload.decode(errors='replace')}
+        if not isinstance(response, dict):
+            response = {'status': response}
+        messages = response.get('messages') or []
+        if messages:
+            self.last_seq = messages[-1]['seq']
+        if 'status' in response:
+            future = self.pending.popleft()
+            if not future.done():
+                future.set_result(response)
+            return
+        now = time.time_ns()
+        for message in messages:
+            text = message['message']
+            if text.startswith(BROADCAST_MARKER):
+                self.stats['lags'].append(
+                    (now - int(text[len(BROADCAST_MARKER):])) / 1e9)
+
+    async def request(self, route: str, request: str, expect_response=True):
+        started = time.perf_counter()
+        future = None
+        if expect_response:
+            future = asyncio.get_running_loop().create_future()
+            self.pending.append(future)
+        self.writer.write(encode_frame(request))
+        await self.writer.drain()
+        response = await future if future is not None else None
+        self.stats['latencies'].setdefault(route, []).append(
+            time.perf_counter() - started)
+        return response
+
+    async def step(self, route: str):
+        user_id = self.user_id
+        match route:
+            case 'connect':
+                response = await self.request(route, 'POST /connect')
+                self.user_id = response['user_id']
+            case 'send':
+                await self.request(
+                    route, f'POST /send public {user_id} '
+                           f'{BROADCAST_MARKER}{time.time_ns()}')
+            case 'send_private':
+                await self.request(
+                    route, f'POST /send {user_id} {user_id} benchmark')
+            case 'unread':
+                await self.request(route, f'GET /unread public {user_id} 50')
+            case 'read':
+                if self.last_seq is None:
+                    return await self.step('status')
+                # /read has no response; its latency is the write only.
+                await self.request(
+                    route, f'POST /read {self.last_seq} {user_id} '
+                           'public', expect_response=False)
+            case 'status':
+                await self.request(route, f'GET /status {user_id}')
+            case 'read_upto':
+                if self.last_seq is None:
+                    return await self.step('status')
+                await self.request(
+                    route, f'POST /read {self.last_seq} {user_id} '
+                           'public upto', expect_response=False)
+            case 'history':
+                await self.request(route, 'GET /history public - - 50')
+            case 'search':
+                await self.request(route, 'GET /search public bench 50')
+
+    def close(self):
+        if self.listener is not None:
+            self.listener.cancel()
+        if self.writer is not None:
+            self.writer.close()
+
+
+async def client(host, port, weights, deadline, stats):
+    connection = Connection(stats)
+    routes, route_weights = list(weights), list(weights.values())
+    try:
+        await connection.open(host, port)
+        while time.perf_counter() < deadline:
+            await connection.step(random.choices(routes, route_weights)[0])
+    except (OSError, KeyError):
+        stats['errors'] += 1
+    finally:
+        connection.close()
+
+
+async def load(host, port, connections, weights, duration):
+    stats = {'latencies': {}, 'lags': [], 'errors': 0}
+    deadline = time.perf_counter() + duration
+    await asyncio.gather(*(client(host, port, weights, deadline, stats)
+                           for _ in range(connections)))
+    return stats
+
+
+def load_process(arguments):
+    _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return asyncio.run(load(*arguments))
+
+
+def quantiles(samples) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+    return {name: round(samples[min(int(q * len(samples)),
+                                    len(samples) - 1)] * 1000, 3)
+            for name, q in QUANTILES.items()}
+
+
+def summarize(results, elapsed) -> dict:
+    latencies, lags, errors = {}, [], 0
+    for stats in results:
+        for route, samples in stats['latencies'].items():
+            latencies.setdefault(route, []).extend(samples)
+        lags.extend(stats['lags'])
+        errors += stats['errors']
+    every = [sample for samples in latencies.values() for sample in samples]
+    return {'requests': len(every),
+            'errors': errors,
+            'seconds': round(elapsed, 3),
+            'throughput': round(len(every) / elapsed, 1),
+            'latency_ms': quantiles(every),
+            'routes': {route: {'requests': len(samples),
+                               'latency_ms': quantiles(samples)}
+                       for route, samples in latencies.items()},
+            'broadcast_lag_ms': quantiles(lags)}
+
+
+def wait_for_port(host, port, timeout=10.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f'Server did not start on {host}:{port}.')
+
+
+def run_load(host, port, args, weights) -> dict:
+    per_process = max(args.connections // args.load_processes, 1)
+    with Pool(args.load_processes) as pool:
+        started = time.perf_counter()
+        results = pool.map(
+            load_process,
+            [(host, port, per_process, weights, args.duration)]
+            * args.load_processes)
+        elapsed = time.perf_counter() - started
+    return {'connections': per_process * args.load_processes,
+            'mix': args.mix,
+            **summarize(results, elapsed)}
+
+
+def run_spawned(workers, args, weights) -> dict:
+    chat_log_dir = tempfile.mkdtemp(prefix='messanger-benchmark-')
+    environment = dict(os.environ, HOST=HOST, PORT=str(BENCHMARK_PORT),
+                       CHAT_LOG_DIR=chat_log_dir)
+    # Each load connection runs far above any per-connection rate limit.
+    environment.setdefault('RATE_LIMIT_SCALE', '0')
+    server = subprocess.Popen(
+        [sys.executable, 'run_server.py', '--workers', str(workers)],
+        cwd=os.path.dirname(os.path.abspath(__file__)), env=environment,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(HOST, BENCHMARK_PORT)
+        return {'workers': workers,
+                **run_load(HOST, BENCHMARK_PORT, args, weights)}
+    finally:
+        server.terminate()
+        server.wait()
+        shutil.rmtree(chat_log_dir, ignore_errors=True)
+
+
+def regressions(results, baseline, tolerance) -> list:
+    found = []
+    previous = {result.get('workers'): result for result in baseline}
+    for result in results:
+        old = previous.get(result.get('workers'))
+        if old is None:
+            continue
+        label = f'workers={result.get("workers")}'
+        if result['throughput'] < old['throughput'] * (1 - tolerance):
+            found.append(f'{label}: throughput '
+                         f'{old["throughput"]} -> {result["throughput"]}')
+        for name in ('p99', 'p999'):
+            before = old['latency_ms'].get(name)
+            after = result['latency_ms'].get(name)
+            if before and after and after > before * (1 + tolerance):
+                found.append(f'{label}: {name} {before} ms -> {after} ms')
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Load generator for the socket protocol. Without '
+                    '--workers it targets a running server, otherwise it '
+                    'starts run_server.py once per worker count.')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, nargs='+')
+    parser.add_argument('--connections', type=int, default=1000)
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='route weights, e.g. send=1,status=4 '
+                             f'(routes: {", ".join(ROUTES)})')
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--load-processes', type=int,
+                        default=os.cpu_count() or 1)
+    parser.add_argument('--output', help='write the results as JSON here')
+    parser.add_argument('--baseline',
+                        help='results of an earlier run to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1)
+    args = parser.parse_args()
+    weights = parse_mix(args.mix)
+
+    if args.workers:
+        results = []
+        for workers in args.workers:
+            results.append(run_spawned(workers, args, weights))
+            print(json.dumps(results[-1]), flush=True)
+    else:
+        results = [run_load(args.host, args.port, args, weights)]
+        print(json.dumps(results[0]), flush=True)
+
+    if args.output:
+        with open(args.output, mode='w') as file:
+            json.dump({'created': time.time(), 'results': results}, file,
+                      indent=2)
+    if args.baseline:
+        with open(args.baseline, mode='r') as file:
+            found = regressions(results, json.load(file)['results'],
+                                args.tolerance)
+        for regression in found:
+            print(f'Regression: {regression}', file=sys.stderr)
+        sys.exit(1 if found else 0)
+
+
+if __name__ == '__main__':
+    main()
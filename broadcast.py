@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import os
+import time
+
+from collections import deque
+from dotenv import load_dotenv
+
+from codec import encode
+from metrics import metrics
+from protocol import encode_frame
+
+load_dotenv()
+
+BROADCAST_QUEUE_SIZE = int(os.getenv('BROADCAST_QUEUE_SIZE', 256))
+BROADCAST_POLICY = os.getenv('BROADCAST_POLICY', 'drop')
+# The coalesce policy merges a full queue into one payload and disconnects
+# the subscriber once that grows past this many bytes.
+BROADCAST_COALESCE_BYTES = int(os.getenv('BROADCAST_COALESCE_BYTES', 1 << 20))
+
+POLICIES = ('drop', 'disconnect', 'coalesce')
+
+
+class Subscriber:
+    __slots__ = ('writer', 'encoding', 'queue', 'ready', 'task', 'policy',
+                 'max_size', 'dropped', 'closed')
+
+    def __init__(self, writer, max_size=BROADCAST_QUEUE_SIZE,
+                 policy=BROADCAST_POLICY):
+        self.writer = writer
+        self.encoding = 'json'
+        self.queue = deque()
+        self.ready = asyncio.Event()
+        self.task = None
+        self.policy = policy
+        self.max_size = max_size
+        self.dropped = 0
+        self.closed = False
+
+    def push(self, frame: bytes, message: dict):
+        if self.closed:
+            return
+        if len(self.queue) >= self.max_size:
+            match self.policy:
+                case 'drop':
+                    self.queue.popleft()
+                    self.dropped += 1
+                    metrics.increment('broadcast_dropped')
+                case 'disconnect':
+                    logging.error('Slow consumer '
+                                  f'{self.writer.get_extra_info("peername")} '
+                                  'disconnected.')
+                    self.close()
+                    return
+                case 'coalesce':
+                    if not self.coalesce():
+                        peer = self.writer.get_extra_info('peername')
+                        logging.error(f'Slow consumer {peer} disconnected.')
+                        self.close()
+                        return
+        self.queue.append((frame, message))
+        self.ready.set()
+
+    def coalesce(self) -> bool:
+        # Merges the queued payloads into a single one encoded for this
+        # subscriber; false once it grows past BROADCAST_COALESCE_BYTES.
+        message = {'messages': [item for _, pending in self.queue
+                                for item in pending['messages']]}
+        frame = encode_frame(encode(message, self.encoding))
+        if len(frame) > BROADCAST_COALESCE_BYTES:
+            return False
+        self.queue.clear()
+        self.queue.append((frame, message))
+        metrics.increment('broadcast_coalesced')
+        return True
+
+    async def drain(self):
+        try:
+            while not self.closed:
+                await self.ready.wait()
+                self.ready.clear()
+                frames = [frame for frame, _ in self.queue]
+                self.queue.clear()
+                started = time.perf_counter()
+                self.writer.writelines(frames)
+                await self.writer.drain()
+                metrics.send_latency.observe(time.perf_counter() - started)
+                metrics.increment('bytes_out', sum(map(len, frames)))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logging.error(f'Broadcast writer stopped: {e}')
+            self.closed = True
+
+    def close(self):
+        self.closed = True
+        self.queue.clear()
+        if self.task is not None:
+            self.task.cancel()
+        self.writer.close()
+
+
+class Broadcaster:
+
+    def __init__(self, max_size=BROADCAST_QUEUE_SIZE,
+                 policy=BROADCAST_POLICY):
+        if policy not in POLICIES:
+            raise ValueError(f'Unknown broadcast policy {policy!r}.')
+        self.max_size = max_size
+        self.policy = policy
+        self.subscribers = {}
+        self.relay = None
+
+    def subscribe(self, writer, addr: str) -> Subscriber:
+        subscriber = Subscriber(writer, self.max_size, self.policy)
+        subscriber.task = asyncio.get_running_loop().create_task(
+            subscriber.drain())
+        self.subscribers[addr] = subscriber
+        return subscriber
+
+    def unsubscribe(self, addr: str):
+        subscriber = self.subscribers.pop(addr, None)
+        if subscriber is not None and subscriber.task is not None:
+            subscriber.task.cancel()
+
+    def set_encoding(self, addr: str, encoding: str):
+        subscriber = self.subscribers.get(addr)
+        if subscriber is not None:
+            subscriber.encoding = encoding
+
+    def publish(self, message: dict, relay=True):
+        if relay and self.relay is not None:
+            self.relay(message)
+        # Encoded once per encoding; subscribers share the same bytes.
+        frames = {}
+        for subscriber in list(self.subscribers.values()):
+            frame = frames.get(subscriber.encoding)
+            if frame is None:
+                frame = frames[subscriber.encoding] = encode_frame(
+                    encode(message, subscriber.encoding))
+            subscriber.push(frame, message)
+
+    def queue_depth(self) -> int:
+        return sum(len(subscriber.queue)
+                   for subscriber in self.subscribers.values())
+
+
+broadcaster = Broadcaster()
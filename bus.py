@@ -0,0 +1,117 @@
+import asyncio
+import json
+import logging
+import os
+import tempfile
+
+from dotenv import load_dotenv
+
+from protocol import RequestParser, encode_frame
+
+load_dotenv()
+
+BUS_PATH = os.getenv('BUS_PATH') or os.path.join(
+    tempfile.gettempdir(), f'messanger-{os.getenv("PORT")}.bus')
+BUS_CONNECT_RETRIES = int(os.getenv('BUS_CONNECT_RETRIES', 50))
+
+
+class BusHub:
+    """Relays every event a worker publishes to all the other workers.
+
+    The latest presence event of every connected user is kept, so a worker
+    that joins late still learns about sessions living on its peers.
+    """
+
+    def __init__(self):
+        self.writers = set()
+        self.presence = {}
+
+    async def handle(self, reader, writer):
+        self.writers.add(writer)
+        writer.writelines([encode_frame(event)
+                           for event in self.presence.values()])
+        parser = RequestParser(text_protocol=False)
+        try:
+            while data := await reader.read(65536):
+                for payload in parser.feed(data):
+                    event = json.loads(payload)
+                    if event['type'] == 'session':
+                        if event['connected']:
+                            self.presence[event['user_id']] = payload
+                        else:
+                            self.presence.pop(event['user_id'], None)
+                    frame = encode_frame(payload)
+                    for other in self.writers:
+                        if other is not writer:
+                            other.write(frame)
+        except Exception as e:
+            logging.error(f'Bus connection failed: {e}')
+        finally:
+            self.writers.discard(writer)
+            writer.close()
+
+    async def serve(self, sock):
+        server = await asyncio.start_unix_server(self.handle, sock=sock)
+        async with server:
+            await server.serve_forever()
+
+
+class BusClient:
+
+    def __init__(self, path: str = BUS_PATH):
+        self.path = path
+        self.handlers = {}
+        self.writer = None
+        self.task = None
+
+    def on(self, event_type: str, handler):
+        self.handlers[event_type] = handler
+
+    async def connect(self, retries: int = BUS_CONNECT_RETRIES):
+        for attempt in range(retries):
+            try:
+                reader, self.writer = await asyncio.open_unix_connection(
+                    self.path)
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                await asyncio.sleep(0.1)
+        else:
+            raise ConnectionError(f'Bus at {self.path} is not available.')
+        self.task = asyncio.create_task(self.listen(reader))
+        logging.info(f'Connected to bus at {self.path}.')
+
+    def publish(self, event_type: str, **fields):
+        if self.writer is not None:
+            self.writer.write(
+                encode_frame(json.dumps({'type': event_type, **fields})))
+
+    async def listen(self, reader):
+        parser = RequestParser(text_protocol=False)
+        while data := await reader.read(65536):
+            for payload in parser.feed(data):
+                event = json.loads(payload)
+                handler = self.handlers.get(event.pop('type'))
+                if handler is not None:
+                    try:
+                        handler(**event)
+                    except Exception as e:
+                        logging.error(f'Bus handler failed: {e}')
+        logging.error('Bus connection closed.')
+
+
+def attach(client: BusClient):
+    import sessions
+    from broadcast import broadcaster
+
+    def publish_session(session):
+        client.publish('session', user_id=session.user_id,
+                       connected=session.connected)
+
+    def publish_broadcast(message):
+        client.publish('broadcast', message=message)
+
+    sessions.registry.observers.append(publish_session)
+    broadcaster.relay = publish_broadcast
+    client.on('session', sessions.registry.update_remote)
+    client.on('broadcast',
+              lambda message: broadcaster.publish(message, relay=False))
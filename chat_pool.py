@@ -0,0 +1,106 @@
+import os
+import resource
+
+from collections import OrderedDict
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def descriptor_budget() -> int:
+    # Keeps a quarter of the descriptor limit for sockets and everything else.
+    soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft == resource.RLIM_INFINITY:
+        soft = 65536
+    return max(soft * 3 // 4, 64)
+
+
+def default_capacity(files_per_chat: int) -> int:
+    return max(descriptor_budget() // files_per_chat, 16)
+
+
+CHAT_POOL_SIZE = int(os.getenv('CHAT_POOL_SIZE') or default_capacity(4))
+# Descriptors the items of every pool may hold together.
+CHAT_POOL_FILES = int(os.getenv('CHAT_POOL_FILES') or descriptor_budget())
+
+
+class FileBudget:
+    """Descriptors held by the items of several pools.
+
+    Once they hold more than ``limit``, the least recently used item of any
+    pool is evicted, so that a pool of small items and one of large items
+    share the limit instead of each assuming it for themselves.
+    """
+
+    def __init__(self, limit=CHAT_POOL_FILES):
+        self.limit = limit
+        self.used = 0
+        # (pool, chat_id) -> descriptors, least recently used first.
+        self.items = OrderedDict()
+
+    def touch(self, pool, chat_id, files: int):
+        key = (pool, chat_id)
+        self.used += files - self.items.get(key, 0)
+        self.items[key] = files
+        self.items.move_to_end(key)
+        while self.used > self.limit and len(self.items) > 1:
+            evicted_pool, evicted_id = next(iter(self.items))
+            evicted_pool.evict(evicted_id)
+
+    def release(self, pool, chat_id):
+        self.used -= self.items.pop((pool, chat_id), 0)
+
+
+open_files = FileBudget()
+
+
+class ChatPool:
+    """Least recently used set of open per-chat objects.
+
+    ``opener(chat_id)`` creates an object on a miss; the least recently
+    used one is closed once more than ``capacity`` are open or the pools
+    sharing ``budget`` hold too many descriptors, and passed to
+    ``on_evict`` first so that its state can be remembered. Objects report
+    the descriptors they hold through ``open_files()``.
+    """
+
+    def __init__(self, opener, capacity=CHAT_POOL_SIZE, on_evict=None,
+                 budget=open_files):
+        self.opener = opener
+        self.capacity = capacity
+        self.on_evict = on_evict
+        self.budget = budget
+        self.items = OrderedDict()
+        self.evictions = 0
+
+    def __contains__(self, chat_id):
+        return chat_id in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def open(self, chat_id: str):
+        item = self.items.get(chat_id)
+        if item is not None:
+            self.items.move_to_end(chat_id)
+        else:
+            item = self.items[chat_id] = self.opener(chat_id)
+            while len(self.items) > self.capacity:
+                self.evict(next(iter(self.items)))
+        self.budget.touch(self, chat_id, item.open_files())
+        return item
+
+    def _close(self, chat_id: str):
+        item = self.items.pop(chat_id)
+        self.budget.release(self, chat_id)
+        if self.on_evict is not None:
+            self.on_evict(chat_id, item)
+        item.close()
+
+    def evict(self, chat_id: str):
+        self._close(chat_id)
+        self.evictions += 1
+
+    def close(self):
+        while self.items:
+            self._close(next(iter(self.items)))
@@ -1,17 +1,21 @@
+import asyncio
+import bisect
 import datetime
-import json
 import logging
 import os
-import select
-import socket
-import struct
-import threading
 
 from dotenv import load_dotenv
+from codec import decode
+from protocol import HEADER, encode_frame
+from rich.cells import cell_len
+from rich.segment import Segment
 from textual.app import App, ComposeResult
-from textual.containers import Container, Vertical, VerticalScroll, Horizontal
+from textual.containers import Container, Vertical, Horizontal
+from textual.geometry import Size
+from textual.scroll_view import ScrollView
+from textual.strip import Strip
 from textual.widgets import (Button, Footer, Header,
-                             Input, Static)
+                             Input, Log)
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
@@ -20,33 +24,102 @@ load_dotenv()
 
 HOST = os.getenv('HOST')
 PORT = os.getenv('PORT')
+UNREAD_PAGE_SIZE = int(os.getenv('UNREAD_LIMIT', 500))
+ENCODING = os.getenv('ENCODING', 'json')
+RECONNECT_DELAY = float(os.getenv('RECONNECT_DELAY', 0.5))
+RECONNECT_MAX_DELAY = float(os.getenv('RECONNECT_MAX_DELAY', 10))
+UI_REFRESH_INTERVAL = float(os.getenv('UI_REFRESH_INTERVAL', 1 / 30))
+SCROLLBACK = int(os.getenv('SCROLLBACK', 5000))
+LOG_SCROLLBACK = int(os.getenv('LOG_SCROLLBACK', 1000))
+READ_ACK_DEBOUNCE = float(os.getenv('READ_ACK_DEBOUNCE', 1.0))
+# Keeps the connection inside the server's IDLE_TIMEOUT.
+HEARTBEAT_INTERVAL = float(os.getenv('HEARTBEAT_INTERVAL', 30))
+UNREAD_STATUSES = ('unread messages received', 'no unread messages')
+REFUSED_STATUSES = ('busy', 'rate limited')
 
-to_monitor = []
-lock = threading.Lock()
-user_id = ''
-event_connect = threading.Event()
+
+class MessageView(ScrollView):
+    """Messages kept sorted by seq, at most ``scrollback`` of them.
+
+    Only the rows inside the viewport are rendered; the oldest messages are
+    dropped from the view once the scrollback is full.
+    """
+
+    def __init__(self, scrollback=SCROLLBACK, **kwargs):
+        super().__init__(**kwargs)
+        self.scrollback = scrollback
+        self.keys = []
+        self.lines = []
+        self.width = 0
+
+    def insert(self, key, line: str) -> bool:
+        position = bisect.bisect_left(self.keys, key)
+        if position < len(self.keys) and self.keys[position] == key:
+            return False
+        self.keys.insert(position, key)
+        self.lines.insert(position, line)
+        self.width = max(self.width, cell_len(line))
+        excess = len(self.keys) - self.scrollback
+        if excess > 0:
+            del self.keys[:excess]
+            del self.lines[:excess]
+        return True
+
+    def clear(self) -> None:
+        self.keys.clear()
+        self.lines.clear()
+        self.width = 0
+        self.update()
+
+    def update(self) -> None:
+        # Keeps following new messages unless scrolled away from the end.
+        follow = self.scroll_offset.y >= self.max_scroll_y
+        self.virtual_size = Size(self.width, len(self.lines))
+        if follow:
+            self.scroll_end(animate=False)
+        self.refresh()
+
+    def render_line(self, y: int) -> Strip:
+        scroll_x, scroll_y = self.scroll_offset
+        index = scroll_y + y
+        width = self.size.width
+        if index >= len(self.lines):
+            return Strip.blank(width, self.rich_style)
+        return Strip([Segment(self.lines[index], self.rich_style)]).crop(
+            scroll_x, scroll_x + width).extend_cell_length(
+            width, self.rich_style)
 
 
 class ClientApp(App):
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        self.client_socket = None
+        self.writer = None
+        self.user_id = ''
+        # Set while a /connect is in flight, also to redo it on reconnect.
+        self.connecting = False
+        # Seqs received since the last /read, acked once per
+        # READ_ACK_DEBOUNCE. After the unread pages are drained every
+        # earlier message has been received and a cumulative ack is enough.
+        self.pending_reads = []
+        self.read_timer = None
+        self.unread_drained = False
+        # The last /unread page requested, sent again if the server refuses
+        # it while overloaded.
+        self.unread_request = None
         self.message_area = None
         self.log_area = None
-        self.messages = []
+        # Changes pending for the two panes, rendered once per refresh tick.
+        self.log_lines = []
+        self.dirty = False
 
     def compose(self) -> ComposeResult:
         yield Header()
         yield Footer()
         yield Container(
             Horizontal(
-                VerticalScroll(
-                    Static(id='message_area'),
-                ),
-                VerticalScroll(
-                    Static(id='log_area', expand=True),
-                ),
+                MessageView(id='message_area'),
+                Log(max_lines=LOG_SCROLLBACK, id='log_area'),
                 Vertical(
                     Input(placeholder='Type your message here...', id='input'),
                     Horizontal(
@@ -65,12 +138,13 @@ class ClientApp(App):
 
     def on_mount(self) -> None:
         self.message_area = self.query_one('#message_area')
-        self.message_area.update('')
         self.log_area = self.query_one('#log_area')
-        self.log_area.update('')
+        self.set_interval(UI_REFRESH_INTERVAL, self.refresh_areas)
+        self.set_interval(HEARTBEAT_INTERVAL, self.heartbeat)
+        self.run_worker(self.transport(), exclusive=True)
 
     def on_input_submitted(self) -> None:
-        request = f'POST /send public {user_id} ' + \
+        request = f'POST /send public {self.user_id} ' + \
             self.query_one('#input').value
         self.send_request(request)
         self.query_one('#input').clear()
@@ -78,131 +152,170 @@ class ClientApp(App):
     def on_button_pressed(self, event) -> None:
         match event.button.id:
             case 'send_button':
-                request = f'POST /send public {user_id} ' + \
+                request = f'POST /send public {self.user_id} ' + \
                     self.query_one('#input').value
                 self.send_request(request)
                 self.query_one('#input').clear()
             case 'connect_button':
-                event_connect.set()
-                self.send_request('POST /connect')
+                self.connect()
             case 'get_unread_button':
-                self.send_request(f'GET /unread public {user_id}')
+                self.request_unread()
             case 'clear_chat_button':
-                self.message_area.update()
+                self.message_area.clear()
             case 'clear_logs_button':
-                self.log_area.update()
+                self.log_lines.clear()
+                self.log_area.clear()
 
     def update_message_area(self, message: str) -> None:
-        self.message_area.update(self.message_area.renderable + '\n' + message)
+        # Statuses have no place in the seq-ordered message view.
+        self.update_log(f'Status: {message}')
 
     def update_log(self, log_message: str) -> None:
-        self.log_area.update(self.log_area.renderable + '\n' + log_message)
+        self.log_lines.append(log_message)
+        if len(self.log_lines) > LOG_SCROLLBACK:
+            del self.log_lines[:-LOG_SCROLLBACK]
+
+    def refresh_areas(self) -> None:
+        if self.log_lines:
+            self.log_area.write_lines(self.log_lines)
+            self.log_lines = []
+        if self.dirty:
+            self.message_area.update()
+            self.dirty = False
+
+    def connect(self, resume: bool = False) -> None:
+        request = f'POST /connect {ENCODING}'
+        if resume and self.user_id:
+            request += f' {self.user_id}'
+        self.connecting = True
+        self.unread_drained = False
+        self.pending_reads.clear()
+        self.send_request(request)
 
     def send_request(self, request: str) -> None:
+        if self.writer is None:
+            self.update_log(f'Not connected, dropped: {request}')
+            return
+        self.writer.write(encode_frame(request))
+        self.update_log(f'Sent: {request}')
+
+    def heartbeat(self) -> None:
+        if self.writer is not None:
+            self.writer.write(encode_frame('GET /ping'))
+
+    async def transport(self) -> None:
+        delay = RECONNECT_DELAY
+        while True:
+            try:
+                reader, self.writer = await asyncio.open_connection(
+                    HOST, int(PORT))
+            except OSError as e:
+                self.update_log(f'Connection failed: {e}, retrying in '
+                                f'{delay:.1f}s.')
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, RECONNECT_MAX_DELAY)
+                continue
+            delay = RECONNECT_DELAY
+            self.update_log(f'Connected to {HOST}:{PORT}.')
+            if self.connecting or self.user_id:
+                # Resumes the session, which the server keeps for a while
+                # after the connection closed, also across its restarts.
+                self.connect(resume=True)
+            try:
+                while True:
+                    header = await reader.readexactly(HEADER.size)
+                    payload = await reader.readexactly(
+                        HEADER.unpack(header)[0])
+                    try:
+                        self.handle_response(payload)
+                    except Exception as e:
+                        # A malformed response must not stop the transport.
+                        self.update_log(f'Error handling response: {e!r}')
+            except (asyncio.IncompleteReadError, OSError) as e:
+                self.update_message_area('Server closed the connection.')
+                self.update_log(f'Connection lost: {e}')
+            finally:
+                self.writer.close()
+                self.writer = None
+
+    def handle_response(self, payload: bytes) -> None:
         try:
-            if not to_monitor or not (self.client_socket in to_monitor):
-                self.client_socket = socket_register()
-            self.client_socket.sendall(request.encode())
-            self.update_log(f'Sent: {request}')
-        except Exception as e:
-            self.update_log(f'Error app: {e}')
+            response_dict = decode(payload)
+        except ValueError as e:
+            self.update_log(f'Error: {e}')
+            return
+        if not isinstance(response_dict, dict):
+            self.update_log(f'Response: {response_dict}')
+            return
+        if self.connecting and 'user_id' in response_dict:
+            self.user_id = response_dict['user_id']
+            self.connecting = False
+            self.update_log(f'user_id updated: {self.user_id}')
+        if response_dict.get('status') == 'pong':
+            return
+        if response_dict.get('status') in REFUSED_STATUSES:
+            self.update_log(f'Server {response_dict["status"]}, retrying '
+                            f'{response_dict.get("route")} in '
+                            f'{response_dict.get("retry_after")}s.')
+            if response_dict.get('route') == '/unread' and \
+                    self.unread_request is not None:
+                request = self.unread_request
+                self.set_timer(float(response_dict.get('retry_after', 1)),
+                               lambda: self.send_request(request))
+            return
+        if 'status' in response_dict:
+            self.update_message_area(str(response_dict['status']))
+        cursor = response_dict.get('cursor')
+        if response_dict.get('status') in UNREAD_STATUSES and not cursor:
+            self.unread_drained = True
+        received_messages = response_dict.get('messages')
+        if not received_messages:
+            return
+        self.add_messages(received_messages)
+        self.mark_read(received_messages)
+        if cursor:
+            self.request_unread(cursor)
+
+    def request_unread(self, cursor: str = None) -> None:
+        self.unread_request = f'GET /unread public {self.user_id}'
+        if cursor:
+            self.unread_request += f' {UNREAD_PAGE_SIZE} {cursor}'
+        self.send_request(self.unread_request)
 
     def add_messages(self, received_messages):
+        added = 0
         for item in received_messages:
             timestamp = datetime.datetime. \
                 fromisoformat(item['timestamp']). \
                 strftime('%Y-%m-%d %H:%M')
-            detailed_message = (f'{timestamp}',
-                                f' user_{item['user_id'][:4]}',
-                                f' {item['message']}')
-            self.messages.append(detailed_message)
-        self.update_log('Messages added to storage.')
+            user = item['user_id'][:4]
+            detailed_message = f'{timestamp}  user_{user}  {item["message"]}'
+            added += self.message_area.insert(item['seq'], detailed_message)
+        self.dirty = self.dirty or bool(added)
+        self.update_log(f'{added} messages added to the view.')
 
     def mark_read(self, received_messages):
-        timestamps = '/'.join(item['timestamp'] for item in received_messages)
-        request = f'POST /read {timestamps} {user_id} public'
-        self.send_request(request)
+        self.pending_reads.extend(item['seq'] for item in received_messages)
+        if self.read_timer is None:
+            self.read_timer = self.set_timer(READ_ACK_DEBOUNCE,
+                                             self.flush_reads)
 
-    def print_messages(self, received_messages):
-        if len(received_messages) == 1:
-            self.update_message_area(self.messages[-1])
-            self.update_log('Message printed.')
+    def flush_reads(self) -> None:
+        self.read_timer = None
+        if not self.pending_reads or not self.user_id:
+            return
+        if self.unread_drained:
+            request = f'POST /read {max(self.pending_reads)} ' \
+                      f'{self.user_id} public upto'
         else:
-            self.messages.sort(key=lambda x: x[0])
-            self.message_area.update()
-            to_render = str()
-            for message in self.messages:
-                to_render += ' '.join(message)
-                to_render += '\n'
-            self.message_area.update(self.message_area.renderable + '\n' + to_render)
-            self.update_log('Messages sorted and printed.')
-
-
-
-def socket_register():
-    server_address = (HOST, int(PORT))
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    client_socket.connect(server_address)
-
-    with lock:
-        to_monitor.append(client_socket)
-    return client_socket
-
-
-def event_loop(app: ClientApp):
-    while True:
-        global user_id
-        with lock:
-            if not to_monitor:
-                continue
-            ready_to_read, _, _ = select.select(to_monitor, [], [])
-        for sock in ready_to_read:
-            try:
-                buffer = sock.recv(4)
-                app.update_log(f'Message byte len is {buffer}')
-                msg_ln = struct.unpack('!I', buffer)[0]
-                if not isinstance(msg_ln, int):
-                    continue
-                response = sock.recv(msg_ln)
-                app.update_log(f'Response received. is {response}')
-                if not response:
-                    app.update_message_area('Server closed the connection.')
-                    with lock:
-                        to_monitor.remove(sock)
-                    sock.close()
-                    user_id = ''
-                else:
-                    response_message = response.decode()
-                    app.update_log('Response decoded.')
-                    response_dict = json.loads(response_message)
-                    app.update_log('json parsed.')
-                    if event_connect.is_set():
-                        user_id = response_dict['user_id']
-                        event_connect.clear()
-                        app.update_log(f'user_id updated: {user_id}')
-                    try:
-                        app.update_message_area(f'{response_dict['status']}')
-                    except KeyError:
-                        pass
-                    received_messages = response_dict['messages']
-                    app.add_messages(received_messages)
-                    app.print_messages(received_messages)
-                    app.mark_read(received_messages)
-            except Exception as e:
-                app.update_log(f'Error: {e}')
-                with lock:
-                    to_monitor.remove(sock)
-                    sock.close()
-                    user_id = ''
+            seqs = '/'.join(map(str, sorted(set(self.pending_reads))))
+            request = f'POST /read {seqs} {self.user_id} public'
+        self.pending_reads = []
+        self.send_request(request)
 
 
 def main():
     app = ClientApp()
-
-    event_loop_thread = threading.Thread(target=event_loop, args=(app,))
-    event_loop_thread.daemon = True
-    event_loop_thread.start()
-
     app.run()
 
 
@@ -0,0 +1,168 @@
+import json
+import struct
+
+from datetime import datetime, timedelta
+
+ENCODINGS = ('json', 'binary')
+# First byte of every binary payload; never the first byte of UTF-8 text.
+BINARY_MAGIC = 0xB1
+HAS_MESSAGES = 0x01
+HAS_SEQS = 0x02
+
+BASE_TIMESTAMP = struct.Struct('!q')
+EPOCH = datetime(1970, 1, 1)
+MICROSECOND = timedelta(microseconds=1)
+
+
+def timestamp_to_us(timestamp: str) -> int:
+    delta = datetime.fromisoformat(timestamp).replace(tzinfo=None) - EPOCH
+    return delta // MICROSECOND
+
+
+def us_to_timestamp(us: int) -> str:
+    return (EPOCH + us * MICROSECOND).isoformat()
+
+
+def write_varint(out: bytearray, value: int):
+    while value > 0x7F:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def read_varint(data, position: int):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def _zigzag(delta: int) -> int:
+    return delta << 1 if delta >= 0 else (-delta << 1) - 1
+
+
+def _unzigzag(value: int) -> int:
+    return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+
+def write_bytes(out: bytearray, value: bytes):
+    write_varint(out, len(value))
+    out += value
+
+
+def read_str(data, position: int):
+    length, position = read_varint(data, position)
+    return bytes(data[position:position + length]).decode(), position + length
+
+
+def encode_binary(response: dict) -> bytes:
+    """Packs a response into a columnar binary payload.
+
+    Layout: magic, flags, the JSON encoded fields other than ``messages``,
+    then the messages as columns: a base timestamp with zigzag varint
+    deltas in microseconds, a table of distinct user_ids with one varint
+    index per message, the length-prefixed message texts and, when every
+    message has one, the seqs as a base with zigzag varint deltas.
+    """
+    messages = response.get('messages')
+    meta = {key: value for key, value in response.items()
+            if key != 'messages'}
+    flags = 0
+    if messages is not None:
+        flags |= HAS_MESSAGES
+        if messages and all('seq' in item for item in messages):
+            flags |= HAS_SEQS
+    out = bytearray((BINARY_MAGIC, flags))
+    write_bytes(out, json.dumps(meta, separators=(',', ':')).encode())
+    if messages is None:
+        return bytes(out)
+
+    write_varint(out, len(messages))
+    if not messages:
+        return bytes(out)
+    timestamps = [timestamp_to_us(item['timestamp']) for item in messages]
+    out += BASE_TIMESTAMP.pack(timestamps[0])
+    previous = timestamps[0]
+    for timestamp in timestamps:
+        write_varint(out, _zigzag(timestamp - previous))
+        previous = timestamp
+
+    users = {}
+    indexes = [users.setdefault(item['user_id'], len(users))
+               for item in messages]
+    write_varint(out, len(users))
+    for user_id in users:
+        write_bytes(out, user_id.encode())
+    for index in indexes:
+        write_varint(out, index)
+    for item in messages:
+        write_bytes(out, item['message'].encode())
+    if flags & HAS_SEQS:
+        previous = messages[0]['seq']
+        write_varint(out, previous)
+        for item in messages:
+            write_varint(out, _zigzag(item['seq'] - previous))
+            previous = item['seq']
+    return bytes(out)
+
+
+def decode_binary(data) -> dict:
+    flags = data[1]
+    meta, position = read_str(data, 2)
+    response = json.loads(meta)
+    if not flags & HAS_MESSAGES:
+        return response
+
+    count, position = read_varint(data, position)
+    response['messages'] = messages = []
+    if not count:
+        return response
+    timestamp = BASE_TIMESTAMP.unpack_from(data, position)[0]
+    position += BASE_TIMESTAMP.size
+    timestamps = []
+    for _ in range(count):
+        zigzag, position = read_varint(data, position)
+        timestamp += _unzigzag(zigzag)
+        timestamps.append(us_to_timestamp(timestamp))
+
+    user_count, position = read_varint(data, position)
+    users = []
+    for _ in range(user_count):
+        user_id, position = read_str(data, position)
+        users.append(user_id)
+    indexes = []
+    for _ in range(count):
+        index, position = read_varint(data, position)
+        indexes.append(index)
+    for timestamp, index in zip(timestamps, indexes):
+        message, position = read_str(data, position)
+        messages.append({'timestamp': timestamp,
+                         'user_id': users[index],
+                         'message': message})
+    if flags & HAS_SEQS:
+        seq, position = read_varint(data, position)
+        for item in messages:
+            delta, position = read_varint(data, position)
+            seq += _unzigzag(delta)
+            item['seq'] = seq
+    return response
+
+
+def encode(response, encoding: str = 'json') -> bytes:
+    if isinstance(response, bytes):
+        return response
+    if isinstance(response, str):
+        return response.encode()
+    if encoding == 'binary':
+        return encode_binary(response)
+    return json.dumps(response).encode()
+
+
+def decode(payload: bytes):
+    if payload[:1] == bytes((BINARY_MAGIC,)):
+        return decode_binary(payload)
+    return json.loads(payload)
@@ -0,0 +1,192 @@
+import logging
+import os
+import zlib
+
+from dotenv import load_dotenv
+
+import message_log
+from chat_pool import ChatPool
+from message_log import ChatLog
+from read_state import ReadStateStore
+from storage import Storage
+
+load_dotenv()
+
+CHAT_LOG_SHARDS = int(os.getenv('CHAT_LOG_SHARDS', 256))
+
+
+def shard_directory(directory: str, chat_id: str,
+                    shards=CHAT_LOG_SHARDS) -> str:
+    if shards <= 1:
+        return directory
+    shard = zlib.crc32(chat_id.encode()) % shards
+    return os.path.join(directory, f'{shard:02x}')
+
+
+class CsvStorage(Storage):
+    """Segmented CSV message logs and journaled read states, one directory
+    per chat under ``CHAT_LOG_DIR/<shard>/``."""
+
+    def __init__(self, directory=None, shards=CHAT_LOG_SHARDS):
+        self.directory = directory or os.getenv('CHAT_LOG_DIR')
+        self.shards = shards
+        # Chats whose directory is known to exist, with the segment bases
+        # their log had when it was last evicted.
+        self.known_chats = {}
+        self.chat_logs = ChatPool(self.open_chat_log,
+                                  on_evict=self.remember_chat_log)
+        self.read_states = ChatPool(self.open_read_state)
+        # user_id -> chats with a read state, scanned on first use.
+        self.chats_by_user = None
+
+    def shard_directory(self, chat_id: str) -> str:
+        return shard_directory(self.directory, chat_id, self.shards)
+
+    def chat_directory(self, chat_id: str) -> str:
+        directory = os.path.join(self.shard_directory(chat_id), chat_id)
+        if chat_id in self.known_chats:
+            return directory
+        flat = os.path.join(self.directory, chat_id)
+        if flat != directory and not os.path.isdir(directory) and \
+                os.path.isfile(os.path.join(flat, f'{0:020d}.log')):
+            # Moves a chat written before the sharded layout into its
+            # shard; another worker may have moved it first.
+            os.makedirs(self.shard_directory(chat_id), exist_ok=True)
+            try:
+                os.rename(flat, directory)
+                for suffix in ('.reads', '.reads.log'):
+                    if os.path.isfile(flat + suffix):
+                        os.rename(flat + suffix, directory + suffix)
+                logging.info(f'Moved chat {chat_id} to {directory}.')
+            except FileNotFoundError:
+                pass
+        return directory
+
+    def open_chat_log(self, chat_id: str) -> ChatLog:
+        chat_log = ChatLog(self.chat_directory(chat_id),
+                           bases=self.known_chats.get(chat_id))
+        self.known_chats[chat_id] = None
+        return chat_log
+
+    def remember_chat_log(self, chat_id: str, chat_log: ChatLog):
+        self.known_chats[chat_id] = None if message_log.SHARED \
+            else chat_log.bases
+
+    def open_read_state(self, chat_id: str) -> ReadStateStore:
+        # Only acks open a store, possibly before any message was stored.
+        directory = os.path.dirname(self.chat_directory(chat_id))
+        os.makedirs(directory, exist_ok=True)
+        return ReadStateStore(directory, chat_id, shared=message_log.SHARED)
+
+    def chat_log(self, chat_id: str) -> ChatLog:
+        return self.chat_logs.open(chat_id)
+
+    def exists(self, chat_id):
+        return chat_id in self.known_chats or \
+            os.path.isdir(self.chat_directory(chat_id))
+
+    def stored_chat_log(self, chat_id: str):
+        # Opening a log creates its directory and active segment, which
+        # reads of a chat nothing was stored in must not leave behind.
+        return self.chat_log(chat_id) if self.exists(chat_id) else None
+
+    def append(self, chat_id, rows):
+        return self.chat_log(chat_id).append(rows)
+
+    def sync(self, chat_ids):
+        for chat_id in chat_ids:
+            # fsync flushes the file, so an evicted chat reopened here still
+            # has the pages its earlier handle wrote synced.
+            self.chat_log(chat_id).fsync()
+
+    def count(self, chat_id):
+        chat_log = self.stored_chat_log(chat_id)
+        return len(chat_log) if chat_log is not None else 0
+
+    def read(self, chat_id, start, stop=None):
+        chat_log = self.stored_chat_log(chat_id)
+        return chat_log.read(start, stop) if chat_log is not None else []
+
+    def tail(self, chat_id, limit):
+        chat_log = self.stored_chat_log(chat_id)
+        return chat_log.tail(limit) if chat_log is not None else []
+
+    def seek_timestamp(self, chat_id, timestamp):
+        chat_log = self.stored_chat_log(chat_id)
+        return chat_log.seek_timestamp(timestamp) \
+            if chat_log is not None else 0
+
+    def find_timestamp(self, chat_id, timestamp):
+        chat_log = self.stored_chat_log(chat_id)
+        return chat_log.find_timestamp(timestamp) \
+            if chat_log is not None else None
+
+    def read_state(self, chat_id, user_id):
+        if chat_id not in self.read_states.items:
+            # Opening the store creates its journal; without one nobody
+            # read in the chat yet.
+            path = self.chat_directory(chat_id)
+            if not os.path.isfile(f'{path}.reads') and \
+                    not os.path.isfile(f'{path}.reads.log'):
+                return None
+        return self.read_states.open(chat_id).get(user_id)
+
+    def _scan_read_states(self) -> dict:
+        chats_by_user = {}
+        directories = [self.directory] + [
+            os.path.join(self.directory, f'{shard:02x}')
+            for shard in range(self.shards if self.shards > 1 else 0)]
+        for directory in directories:
+            if not os.path.isdir(directory):
+                continue
+            for name in os.listdir(directory):
+                if name.endswith('.reads'):
+                    chat_id = name[:-len('.reads')]
+                elif name.endswith('.reads.log'):
+                    chat_id = name[:-len('.reads.log')]
+                else:
+                    continue
+                # The user_id leads both snapshot rows and journal lines.
+                with open(os.path.join(directory, name), mode='r') as file:
+                    for line in file:
+                        user_id = line.replace(',', ' ').partition(' ')[0]
+                        if user_id.strip():
+                            chats_by_user.setdefault(
+                                user_id, set()).add(chat_id)
+        for chat_id, read_state in self.read_states.items.items():
+            for user_id in read_state.states:
+                chats_by_user.setdefault(user_id, set()).add(chat_id)
+        return chats_by_user
+
+    def user_chats(self, user_id):
+        if self.chats_by_user is None:
+            self.chats_by_user = self._scan_read_states()
+        return set(self.chats_by_user.get(user_id, ()))
+
+    def _add_user_chat(self, chat_id, user_id):
+        if self.chats_by_user is not None:
+            self.chats_by_user.setdefault(user_id, set()).add(chat_id)
+
+    def ack(self, chat_id, user_id, seqs):
+        self._add_user_chat(chat_id, user_id)
+        return self.read_states.open(chat_id).ack(user_id, seqs)
+
+    def ack_upto(self, chat_id, user_id, watermark):
+        self._add_user_chat(chat_id, user_id)
+        return self.read_states.open(chat_id).ack_upto(user_id, watermark)
+
+    def flush_reads(self):
+        for read_state in list(self.read_states.items.values()):
+            read_state.flush()
+
+    def gauges(self):
+        return {'open_chat_logs': lambda: len(self.chat_logs),
+                'chat_log_evictions': lambda: self.chat_logs.evictions,
+                'segment_cache_bytes': lambda: message_log.segment_cache.size,
+                'segment_cache_misses':
+                    lambda: message_log.segment_cache.misses}
+
+    def close(self):
+        self.read_states.close()
+        self.chat_logs.close()
+        message_log.compressor.shutdown()
@@ -0,0 +1,112 @@
+import os
+import sys
+
+from collections import OrderedDict, deque
+from dotenv import load_dotenv
+
+load_dotenv()
+
+HISTORY_CACHE_SIZE = int(os.getenv('HISTORY_CACHE_SIZE', 100))
+HISTORY_CACHE_BUDGET = int(os.getenv('HISTORY_CACHE_BUDGET', 64 << 20))
+
+# Rough per-message overhead of the slotted record and its deque slot.
+MESSAGE_OVERHEAD = 120
+
+
+class CachedMessage:
+    __slots__ = ('timestamp', 'user_id', 'message')
+
+    def __init__(self, timestamp: str, user_id: str, message: str):
+        self.timestamp = timestamp
+        self.user_id = sys.intern(user_id)
+        self.message = message
+
+    @property
+    def size(self) -> int:
+        return MESSAGE_OVERHEAD + len(self.timestamp) + len(self.message)
+
+    def as_dict(self, seq: int) -> dict:
+        return {'timestamp': self.timestamp,
+                'user_id': self.user_id,
+                'message': self.message,
+                'seq': seq}
+
+
+class ChatHistory:
+    __slots__ = ('messages', 'count', 'size')
+
+    def __init__(self, capacity: int):
+        self.messages = deque(maxlen=capacity)
+        # Length of the chat log the cached tail was taken from.
+        self.count = 0
+        self.size = 0
+
+    def extend(self, rows) -> int:
+        grown = 0
+        for row in rows:
+            if len(self.messages) == self.messages.maxlen:
+                grown -= self.messages[0].size
+            message = CachedMessage(row['timestamp'], row['user_id'],
+                                    row['message'])
+            self.messages.append(message)
+            grown += message.size
+        self.size += grown
+        return grown
+
+    def latest(self, limit: int) -> list:
+        start = max(len(self.messages) - limit, 0)
+        # The cached messages are the last of the ``count`` in the chat.
+        first_seq = self.count - len(self.messages)
+        return [self.messages[position].as_dict(first_seq + position)
+                for position in range(start, len(self.messages))]
+
+
+class HistoryCache:
+    """Most recent messages of every hot chat, evicted LRU-first once the
+    estimated size exceeds the budget."""
+
+    def __init__(self, capacity=HISTORY_CACHE_SIZE,
+                 budget=HISTORY_CACHE_BUDGET):
+        self.capacity = capacity
+        self.budget = budget
+        self.chats = OrderedDict()
+        self.size = 0
+
+    def get(self, chat_id: str, count: int):
+        history = self.chats.get(chat_id)
+        if history is None:
+            return None
+        if history.count != count:
+            self.drop(chat_id)
+            return None
+        self.chats.move_to_end(chat_id)
+        return history
+
+    def warm(self, chat_id: str, rows, count: int) -> ChatHistory:
+        self.drop(chat_id)
+        history = self.chats[chat_id] = ChatHistory(self.capacity)
+        self.size += history.extend(rows)
+        history.count = count
+        self._evict()
+        return history
+
+    def append(self, chat_id: str, rows, first_seq: int):
+        history = self.chats.get(chat_id)
+        if history is None:
+            return
+        if history.count != first_seq:
+            self.drop(chat_id)
+            return
+        self.size += history.extend(rows)
+        history.count += len(rows)
+        self._evict()
+
+    def drop(self, chat_id: str):
+        history = self.chats.pop(chat_id, None)
+        if history is not None:
+            self.size -= history.size
+
+    def _evict(self):
+        while self.size > self.budget and len(self.chats) > 1:
+            _, history = self.chats.popitem(last=False)
+            self.size -= history.size
@@ -0,0 +1,443 @@
+import bisect
+import csv
+import fcntl
+import io
+import logging
+import os
+import lzma
+import struct
+import zlib
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from dotenv import load_dotenv
+
+from codec import timestamp_to_us
+
+load_dotenv()
+
+SEGMENT_ROWS = int(os.getenv('SEGMENT_ROWS', 100000))
+# The active segment is also sealed once its first row is this old; 0 only
+# seals by row count.
+SEGMENT_SECONDS = float(os.getenv('SEGMENT_SECONDS', 0))
+SEGMENT_COMPRESSION = os.getenv('SEGMENT_COMPRESSION', 'zlib')
+SEGMENT_CACHE_BYTES = int(os.getenv('SEGMENT_CACHE_BYTES', 64 * 1024 * 1024))
+# Set when several worker processes append to the same logs.
+SHARED = False
+
+# One index entry per row: (timestamp in microseconds, end offset of the row
+# in the segment data file). Row n of a segment starts where row n - 1 ends.
+INDEX_ENTRY = struct.Struct('!qQ')
+FIELDS = ('timestamp', 'user_id', 'message')
+
+# Header of a compressed sealed segment (.logz): magic, codec and
+# uncompressed size. Seeks find segments through their uncompressed .idx,
+# which keeps the timestamp of every row.
+SEGMENT_HEADER = struct.Struct('!4sBQ')
+SEGMENT_MAGIC = b'MSGZ'
+CODECS = {'zlib': (1, lambda data: zlib.compress(data, 6), zlib.decompress),
+          'lzma': (2, lzma.compress, lzma.decompress)}
+DECOMPRESS = {number: decompress for number, _, decompress in CODECS.values()}
+
+
+def encode_rows(rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    chunks = []
+    for row in rows:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        chunks.append(buffer.getvalue().encode())
+    return chunks
+
+
+def decode_row(chunk: bytes) -> dict:
+    row = next(csv.reader(io.StringIO(chunk.decode(), newline='')))
+    return dict(zip(FIELDS, row))
+
+
+def compress_segment(data_path, compressed_path,
+                     compression=SEGMENT_COMPRESSION):
+    codec, compress, _ = CODECS[compression]
+    try:
+        with open(data_path, 'rb') as file:
+            data = file.read()
+    except FileNotFoundError:
+        # Compressed by another process meanwhile.
+        return
+    # Per process: workers opening the same chat may all find a segment
+    # left uncompressed.
+    temporary_path = f'{compressed_path}.{os.getpid()}.tmp'
+    with open(temporary_path, 'wb') as file:
+        file.write(SEGMENT_HEADER.pack(SEGMENT_MAGIC, codec, len(data)))
+        file.write(compress(data))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary_path, compressed_path)
+    try:
+        os.unlink(data_path)
+    except FileNotFoundError:
+        pass
+
+
+def _compress_sealed(*args):
+    try:
+        compress_segment(*args)
+    except Exception as e:
+        logging.error(f'Error compressing segment {args[0]}: {e}')
+
+
+# Sealed segments are compressed here, off the lock of their writer; reads
+# use the plain .log until the .logz has replaced it.
+compressor = ThreadPoolExecutor(max_workers=1,
+                                thread_name_prefix='compress')
+
+
+class SegmentCache:
+    """Decompressed sealed segments, least recently used first out once
+    they take more than ``budget`` bytes."""
+
+    def __init__(self, budget=SEGMENT_CACHE_BYTES):
+        self.budget = budget
+        self.size = 0
+        self.segments = OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, path) -> bytes:
+        data = self.segments.get(path)
+        if data is not None:
+            self.segments.move_to_end(path)
+            self.hits += 1
+            return data
+        self.misses += 1
+        with open(path, 'rb') as file:
+            magic, codec, size = SEGMENT_HEADER.unpack(
+                file.read(SEGMENT_HEADER.size))
+            data = DECOMPRESS[codec](file.read())
+        if magic != SEGMENT_MAGIC or len(data) != size:
+            raise ValueError(f'Corrupt compressed segment {path}.')
+        self.segments[path] = data
+        self.size += len(data)
+        while self.size > self.budget and len(self.segments) > 1:
+            _, evicted = self.segments.popitem(last=False)
+            self.size -= len(evicted)
+        return data
+
+
+segment_cache = SegmentCache()
+
+
+class ChatLog:
+    """Segmented append-only message log with a per-row offset index."""
+
+    def __init__(self, directory, segment_rows=SEGMENT_ROWS, shared=None,
+                 bases=None, segment_seconds=SEGMENT_SECONDS,
+                 compression=SEGMENT_COMPRESSION):
+        self.directory = directory
+        self.segment_rows = segment_rows
+        self.segment_seconds = segment_seconds
+        self.compression = compression
+        self.shared = SHARED if shared is None else shared
+        # Segment bases remembered from an earlier handle on this chat skip
+        # the directory scan; other processes may seal segments when shared.
+        if bases is None or self.shared:
+            os.makedirs(directory, exist_ok=True)
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a+b') \
+            if self.shared else None
+        self._first_us = {}
+        self.data = None
+        self.index = None
+        with self.locked():
+            self.bases = self._list_bases() if bases is None or self.shared \
+                else list(bases)
+            self._open_active()
+        if bases is None or self.shared:
+            self._compress_leftovers()
+
+    def __len__(self):
+        if self.shared:
+            self._refresh()
+        return self.bases[-1] + self.active_rows
+
+    def _list_bases(self):
+        return sorted({int(name.partition('.')[0])
+                       for name in os.listdir(self.directory)
+                       if name.endswith(('.log', '.logz'))}) or [0]
+
+    def _compress_leftovers(self):
+        # A crash between sealing a segment and compressing it in the
+        # background leaves the sealed segment plain.
+        if self.compression not in CODECS:
+            return
+        sealed = set(self.bases[:-1])
+        for name in os.listdir(self.directory):
+            base, _, suffix = name.partition('.')
+            if suffix == 'log' and int(base) in sealed:
+                compressor.submit(_compress_sealed,
+                                  os.path.join(self.directory, name),
+                                  self._compressed_path(int(base)),
+                                  self.compression)
+
+    def _paths(self, base):
+        name = os.path.join(self.directory, f'{base:020d}')
+        return f'{name}.log', f'{name}.idx'
+
+    def _compressed_path(self, base):
+        return os.path.join(self.directory, f'{base:020d}.logz')
+
+    @contextmanager
+    def locked(self):
+        if self.lock_file is None:
+            yield
+            return
+        fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _open_active(self, recover=True):
+        data_path, index_path = self._paths(self.bases[-1])
+        self.data = open(data_path, 'a+b')
+        self.index = open(index_path, 'a+b')
+        if recover:
+            self._recover()
+        else:
+            self.active_rows = self.data_end = 0
+            self._refresh()
+
+    def _refresh(self):
+        # Picks up rows and segments appended by other processes.
+        index_fd = self.index.fileno()
+        rows = os.fstat(index_fd).st_size // INDEX_ENTRY.size
+        if rows != self.active_rows:
+            self.active_rows = rows
+            self.data_end = self._entry(index_fd, rows - 1)[1] if rows else 0
+        # A process sealing the active segment, by row count or by age,
+        # creates the index of the next one before it lets go of the lock.
+        if rows and os.path.exists(self._paths(self.bases[-1] + rows)[1]):
+            bases = self._list_bases()
+            if bases[-1] != self.bases[-1]:
+                self._close_active()
+                self.bases = bases
+                self._open_active(recover=False)
+
+    def _recover(self):
+        index_fd, data_fd = self.index.fileno(), self.data.fileno()
+        rows = os.fstat(index_fd).st_size // INDEX_ENTRY.size
+        data_size = os.fstat(data_fd).st_size
+        end = 0
+        while rows:
+            end = self._entry(index_fd, rows - 1)[1]
+            if end <= data_size:
+                break
+            rows -= 1
+        else:
+            end = 0
+        # Drop a torn tail left behind by a crash between the data and the
+        # index write, so that both files agree on the row count.
+        os.ftruncate(index_fd, rows * INDEX_ENTRY.size)
+        os.ftruncate(data_fd, end)
+        self.active_rows = rows
+        self.data_end = end
+
+    def _close_active(self):
+        for file in (self.data, self.index):
+            if file is not None:
+                file.close()
+        self.data = self.index = None
+
+    def open_files(self) -> int:
+        return sum(file is not None
+                   for file in (self.data, self.index, self.lock_file))
+
+    def close(self):
+        if self.data is not None:
+            self.flush()
+        self._close_active()
+        if self.lock_file is not None:
+            self.lock_file.close()
+            self.lock_file = None
+
+    def flush(self):
+        self.data.flush()
+        self.index.flush()
+
+    def fsync(self):
+        self.flush()
+        os.fsync(self.data.fileno())
+        os.fsync(self.index.fileno())
+
+    @staticmethod
+    def _entry(fd, position):
+        return INDEX_ENTRY.unpack(
+            os.pread(fd, INDEX_ENTRY.size, position * INDEX_ENTRY.size))
+
+    def _seal(self):
+        base, rows = self.bases[-1], self.active_rows
+        self._close_active()
+        self.bases.append(base + rows)
+        self._open_active()
+        if self.compression in CODECS and rows:
+            data_path, _ = self._paths(base)
+            compressor.submit(_compress_sealed, data_path,
+                              self._compressed_path(base), self.compression)
+
+    def append(self, rows):
+        with self.locked():
+            if self.shared:
+                self._refresh()
+            return self._append(rows)
+
+    def _append(self, rows):
+        first_seq = self.bases[-1] + self.active_rows
+        # Rows without a timestamp are stamped under the lock, which keeps
+        # timestamps ordered even with several writer processes.
+        for row in rows:
+            if row[0] is None:
+                row[0] = datetime.now().isoformat()
+        chunks = encode_rows(rows)
+        position = 0
+        if self.segment_seconds and self.active_rows and \
+                timestamp_to_us(rows[0][0]) - self._first_timestamp(
+                    len(self.bases) - 1) >= self.segment_seconds * 1e6:
+            self._seal()
+        while position < len(rows):
+            if self.active_rows >= self.segment_rows:
+                self._seal()
+            count = min(len(rows) - position,
+                        self.segment_rows - self.active_rows)
+            entries = []
+            end = self.data_end
+            for row, chunk in zip(rows[position:position + count],
+                                  chunks[position:position + count]):
+                end += len(chunk)
+                entries.append(INDEX_ENTRY.pack(timestamp_to_us(row[0]), end))
+            self.data.write(b''.join(chunks[position:position + count]))
+            self.data.flush()
+            self.index.write(b''.join(entries))
+            self.index.flush()
+            self.active_rows += count
+            self.data_end = end
+            position += count
+        return first_seq
+
+    @contextmanager
+    def _index_file(self, number):
+        # The active segment is read through the handles kept open for
+        # appending; sealed segments are opened for the duration of a read.
+        if number == len(self.bases) - 1 and self.index is not None:
+            yield self.index.fileno()
+            return
+        _, index_path = self._paths(self.bases[number])
+        with open(index_path, 'rb') as index:
+            yield index.fileno()
+
+    @contextmanager
+    def _segment_data(self, number):
+        # Yields a file descriptor, or the bytes of a compressed segment
+        # decompressed through the shared cache.
+        if number == len(self.bases) - 1 and self.data is not None:
+            yield self.data.fileno()
+            return
+        data_path, _ = self._paths(self.bases[number])
+        try:
+            data = open(data_path, 'rb')
+        except FileNotFoundError:
+            yield segment_cache.get(self._compressed_path(self.bases[number]))
+            return
+        with data:
+            yield data.fileno()
+
+    def _segment_rows(self, number):
+        if number == len(self.bases) - 1:
+            return self.active_rows
+        return self.bases[number + 1] - self.bases[number]
+
+    def _read_segment(self, number, start, stop):
+        with self._index_file(number) as index_fd:
+            raw = os.pread(index_fd,
+                           (stop - start + (start > 0)) * INDEX_ENTRY.size,
+                           (start - (start > 0)) * INDEX_ENTRY.size)
+        ends = [end for _, end in INDEX_ENTRY.iter_unpack(raw)]
+        begin = ends.pop(0) if start > 0 else 0
+        with self._segment_data(number) as data:
+            chunk = os.pread(data, ends[-1] - begin, begin) \
+                if isinstance(data, int) else data[begin:ends[-1]]
+        # Rows are sliced out by offset; re-slicing the tail after every
+        # row would copy the rest of the chunk each time.
+        first = begin
+        rows = []
+        for end in ends:
+            rows.append(decode_row(chunk[begin - first:end - first]))
+            begin = end
+        return rows
+
+    def read(self, start, stop=None):
+        total = len(self)
+        start = max(start, 0)
+        stop = total if stop is None else min(stop, total)
+        rows = []
+        if start >= stop:
+            return rows
+        first = start
+        number = bisect.bisect_right(self.bases, start) - 1
+        while start < stop:
+            base = self.bases[number]
+            local_stop = min(stop - base, self._segment_rows(number))
+            rows.extend(self._read_segment(number, start - base, local_stop))
+            start = base + local_stop
+            number += 1
+        for seq, row in enumerate(rows, first):
+            row['seq'] = seq
+        return rows
+
+    def tail(self, limit):
+        return self.read(len(self) - limit)
+
+    def _first_timestamp(self, number):
+        base = self.bases[number]
+        if base not in self._first_us:
+            with self._index_file(number) as index_fd:
+                self._first_us[base] = self._entry(index_fd, 0)[0]
+        return self._first_us[base]
+
+    def seek_timestamp(self, timestamp):
+        """Return the sequence number of the first row at or after
+        ``timestamp``."""
+        target = timestamp_to_us(timestamp)
+        if not len(self):
+            return 0
+        lo, hi = 0, len(self.bases)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._segment_rows(mid) and \
+                    self._first_timestamp(mid) <= target:
+                lo = mid + 1
+            else:
+                hi = mid
+        number = max(lo - 1, 0)
+        with self._index_file(number) as fd:
+            lo, hi = 0, self._segment_rows(number)
+            while lo < hi:
+                mid = (lo + hi) // 2
+                if self._entry(fd, mid)[0] < target:
+                    lo = mid + 1
+                else:
+                    hi = mid
+        return self.bases[number] + lo
+
+    def find_timestamp(self, timestamp):
+        seq = self.seek_timestamp(timestamp)
+        if seq < len(self) and \
+                self.timestamp_us(seq) == timestamp_to_us(timestamp):
+            return seq
+        return None
+
+    def timestamp_us(self, seq):
+        number = bisect.bisect_right(self.bases, seq) - 1
+        with self._index_file(number) as index_fd:
+            return self._entry(index_fd, seq - self.bases[number])[0]
@@ -0,0 +1,109 @@
+import asyncio
+import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+DURABILITY = os.getenv('DURABILITY', 'none')
+FSYNC_INTERVAL = float(os.getenv('FSYNC_INTERVAL', 1.0))
+
+DURABILITY_MODES = ('none', 'batch', 'interval')
+
+
+class MessageWriter:
+    """Group-commit writer for chat messages.
+
+    Records submitted while a batch is being written are collected and
+    written together in the next batch, off the event loop. A submitter is
+    resumed once its record reached the configured durability:
+
+    * ``none``: written and flushed to the OS,
+    * ``batch``: fsynced together with its batch,
+    * ``interval``: fsynced by the next periodic fsync.
+    """
+
+    def __init__(self, commit, sync, durability=DURABILITY,
+                 interval=FSYNC_INTERVAL, executor=None):
+        if durability not in DURABILITY_MODES:
+            raise ValueError(f'Unknown durability mode {durability!r}.')
+        self.commit = commit
+        self.sync = sync
+        self.durability = durability
+        self.interval = interval
+        self.executor = executor
+        self.pending = []
+        self.unsynced = set()
+        self.waiting = []
+        self.wakeup = None
+        self.tasks = []
+
+    def _start(self):
+        loop = asyncio.get_running_loop()
+        self.wakeup = asyncio.Event()
+        self.tasks.append(loop.create_task(self._write_batches()))
+        if self.durability == 'interval':
+            self.tasks.append(loop.create_task(self._sync_periodically()))
+
+    async def submit(self, chat_id: str, row: list):
+        if self.wakeup is None:
+            self._start()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((chat_id, row, future))
+        self.wakeup.set()
+        return await future
+
+    def _commit(self, batch):
+        chat_ids = self.commit([(chat_id, row) for chat_id, row, _ in batch])
+        if self.durability == 'batch':
+            self.sync(chat_ids)
+        return chat_ids
+
+    @staticmethod
+    def _resolve(batch):
+        for _, row, future in batch:
+            if not future.done():
+                future.set_result(row)
+
+    async def _write_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            batch, self.pending = self.pending, []
+            if not batch:
+                continue
+            try:
+                chat_ids = await loop.run_in_executor(self.executor,
+                                                      self._commit, batch)
+            except Exception as e:
+                logging.error(f'Error writing {len(batch)} messages: {e}')
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            if self.durability == 'interval':
+                self.unsynced.update(chat_ids)
+                self.waiting.extend(batch)
+            else:
+                self._resolve(batch)
+
+    async def _sync_periodically(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            if not self.waiting:
+                continue
+            chat_ids, self.unsynced = self.unsynced, set()
+            batch, self.waiting = self.waiting, []
+            try:
+                await loop.run_in_executor(self.executor, self.sync,
+                                           chat_ids)
+            except Exception as e:
+                logging.error(f'Error syncing chat logs: {e}')
+                for _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            self._resolve(batch)
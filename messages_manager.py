@@ -1,104 +1,341 @@
-import csv
+import asyncio
+import atexit
+import base64
+import binascii
 import logging
 import os
+import struct
 import threading
 
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
 
+from chat_pool import ChatPool
+import message_log
+from codec import timestamp_to_us, us_to_timestamp
+from csv_storage import shard_directory
+from history_cache import HistoryCache
+from message_log import FIELDS
+from message_writer import MessageWriter
+from read_state import READ_ACK_FLUSH_INTERVAL
+from search_index import SearchIndex
+from storage import open_storage
+from unread_counters import UnreadCounters
+
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
 load_dotenv()
 
 CHAT_LOG_DIR = os.getenv('CHAT_LOG_DIR')
+UNREAD_LIMIT = int(os.getenv('UNREAD_LIMIT', 500))
+HISTORY_LIMIT = int(os.getenv('HISTORY_LIMIT', 100))
+SEARCH_LIMIT = int(os.getenv('SEARCH_LIMIT', 50))
+STORAGE_THREADS = int(os.getenv('STORAGE_THREADS', 4))
 os.makedirs(CHAT_LOG_DIR, exist_ok=True)
+SEARCH_INDEX_DIR = os.getenv('SEARCH_INDEX_DIR') or \
+    os.path.join(CHAT_LOG_DIR, 'search')
+
+# Reentrant so that helpers can run while a caller holds it. Storage
+# backends are not thread-safe, and a pooled chat log must not be evicted
+# while in use, so every storage call happens under it.
+lock = threading.RLock()
+storage = open_storage()
+history_cache = HistoryCache()
+unread_counters = UnreadCounters(storage, shared=message_log.SHARED)
+
+
+def open_search_index(chat_id: str) -> SearchIndex:
+    return SearchIndex(
+        os.path.join(shard_directory(SEARCH_INDEX_DIR, chat_id), chat_id),
+        lambda start, stop: storage.read(chat_id, start, stop), lock)
+
+
+search_indexes = ChatPool(open_search_index)
+# Chats whose search index is being caught up with their log, flushed or
+# merged in the background.
+indexing = set()
+# Storage calls of the event loop run here, never on the loop itself.
+executor = ThreadPoolExecutor(max_workers=STORAGE_THREADS,
+                              thread_name_prefix='storage')
+
+
+async def call(function, *args):
+    return await asyncio.get_running_loop().run_in_executor(
+        executor, function, *args)
+
+
+def write_batch(batch):
+    rows_by_chat = {}
+    for chat_id, row in batch:
+        rows_by_chat.setdefault(chat_id, []).append(row)
+    with lock:
+        for chat_id, rows in rows_by_chat.items():
+            first_seq = storage.append(chat_id, rows)
+            # Stored rows carry their seq after the three fields.
+            for seq, row in enumerate(rows, first_seq):
+                row.append(seq)
+            history_cache.append(
+                chat_id, [dict(zip(FIELDS, row)) for row in rows], first_seq)
+            unread_counters.appended(chat_id, first_seq + len(rows))
+            search_index = search_indexes.open(chat_id)
+            search_index.add(first_seq, [row[2] for row in rows])
+            if search_index.end < first_seq + len(rows) or \
+                    search_index.full():
+                schedule_indexing(chat_id)
+    logging.debug('%d messages saved to %d chats.', len(batch),
+                  len(rows_by_chat))
+    return set(rows_by_chat)
+
+
+def schedule_indexing(chat_id: str):
+    with lock:
+        if chat_id in indexing:
+            return
+        indexing.add(chat_id)
+        try:
+            executor.submit(maintain_search_index, chat_id)
+        except RuntimeError:
+            # The executor shut down; the index catches up when reopened.
+            indexing.discard(chat_id)
+
+
+def maintain_search_index(chat_id: str):
+    # Catches up one batch at a time, so that writers wait for a batch, not
+    # for the whole backlog of a chat whose index is far behind; segments
+    # are written and merged without the lock.
+    again = False
+    try:
+        with lock:
+            if chat_id not in indexing:
+                # Closed meanwhile.
+                return
+            search_index = search_indexes.open(chat_id)
+            done = search_index.catch_up(storage.count(chat_id), batches=1)
+            full = search_index.full()
+        if full:
+            search_index.flush()
+            while search_index.merge():
+                pass
+        with lock:
+            again = not done or search_index.full()
+    except Exception as e:
+        logging.error(f'Error indexing chat {chat_id}: {e}')
+    with lock:
+        indexing.discard(chat_id)
+        if again:
+            schedule_indexing(chat_id)
+
+
+def sync_chats(chat_ids):
+    with lock:
+        storage.sync(chat_ids)
+
+
+message_writer = MessageWriter(write_batch, sync_chats, executor=executor)
 
-lock = threading.Lock()
+
+async def save_message(message: str, user_id: str, chat_id: str = 'public'):
+    return await message_writer.submit(chat_id, [None, user_id, message])
 
 
 def save_message_to_csv(message: str, user_id: str,
                         chat_id: str = 'public'):
-    chat_log_file = os.path.join(CHAT_LOG_DIR, f'{chat_id}.csv')
-    message_data = [datetime.now().isoformat(), user_id, message]
+    message_data = [None, user_id, message]
 
     try:
-        file_exists = os.path.isfile(chat_log_file)
-
-        with open(chat_log_file, mode='a', newline='') as file:
-            writer = csv.writer(file)
-            if not file_exists:
-                writer.writerow(['timestamp', 'user_id', 'message'])
-            writer.writerow(message_data)
-            logging.info(f'Message saved to {chat_log_file}.')
+        write_batch([(chat_id, message_data)])
         return message_data
     except Exception as e:
         logging.error(f'Error saving message to csv: {e}')
 
 
 def get_latest_messages(chat_id: str, limit: int = 20):
-    chat_log_file = os.path.join(CHAT_LOG_DIR, f'{chat_id}.csv')
-    messages = []
-
-    if os.path.isfile(chat_log_file):
-        with open(chat_log_file, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            messages = list(reader)[-limit:]
-    return messages
-
-
-def update_message_status(timestamps: str, user_id: str, chat_id: str = 'public'):
-    status_file = os.path.join(CHAT_LOG_DIR, f'{chat_id}_statuses.csv')
-    timestamp_list = timestamps.split('/')
-    updated_statuses = {}
-
-    if os.path.isfile(status_file):
-        with open(status_file, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            updated_statuses = list(reader)
-
-    for timestamp in timestamp_list:
-        found = False
-        for status in updated_statuses:
-            if status['timestamp'] == timestamp and status['user_id'] == user_id:
-                found = True
-                break
-        if not found:
-            updated_statuses.append({'timestamp': timestamp, 'user_id': user_id})
+    with lock:
+        if limit > history_cache.capacity:
+            return storage.tail(chat_id, limit)
+        count = storage.count(chat_id)
+        history = history_cache.get(chat_id, count)
+        if history is None:
+            history = history_cache.warm(
+                chat_id, storage.tail(chat_id, history_cache.capacity), count)
+        return history.latest(limit)
+
+
+def find_message(chat_id: str, key: str, total: int):
+    """Return the seq of the message keyed by a seq or a timestamp."""
+    if key.isdigit():
+        return int(key) if int(key) < total else None
+    try:
+        return storage.find_timestamp(chat_id, key)
+    except ValueError:
+        return None
+
 
+def update_message_status(keys: str, user_id: str, chat_id: str = 'public',
+                          upto: bool = False):
+    """Ack the messages of ``keys``, seqs or timestamps joined with '/';
+    with ``upto`` every message up to the single key is read."""
     try:
-        with open(status_file, mode='w', newline='') as file:
-            writer = csv.DictWriter(file, fieldnames=['timestamp', 'user_id'])
-            writer.writeheader()
-            writer.writerows(updated_statuses)
+        with lock:
+            total = storage.count(chat_id)
+            if upto:
+                if keys.isdigit():
+                    watermark = min(int(keys) + 1, total)
+                else:
+                    # Everything stamped at or before the timestamp is read.
+                    watermark = storage.seek_timestamp(
+                        chat_id, us_to_timestamp(timestamp_to_us(keys) + 1))
+                storage.ack_upto(chat_id, user_id, watermark)
+                unread_counters.acked(
+                    chat_id, user_id, storage.read_state(chat_id, user_id))
+                return
+            seqs = []
+            for key in keys.split('/'):
+                seq = find_message(chat_id, key, total)
+                if seq is None:
+                    logging.error(f'No message {key} in chat {chat_id}.')
+                    continue
+                seqs.append(seq)
+            if storage.ack(chat_id, user_id, seqs):
+                unread_counters.acked(
+                    chat_id, user_id, storage.read_state(chat_id, user_id))
     except Exception as e:
         logging.error(f'Error updating message status: {e}')
 
 
+def start_at_tail(user_id: str, chat_id: str = 'public'):
+    """Mark every message of the chat read for a user who has no read state
+    there yet, so that a new user's acks advance the watermark from the
+    tail instead of piling up above a watermark of 0."""
+    with lock:
+        if storage.read_state(chat_id, user_id) is not None:
+            return
+        if storage.ack_upto(chat_id, user_id, storage.count(chat_id)):
+            unread_counters.acked(
+                chat_id, user_id, storage.read_state(chat_id, user_id))
+
+
+def flush_read_states():
+    with lock:
+        storage.flush_reads()
+
+
+async def flush_read_states_periodically(interval=READ_ACK_FLUSH_INTERVAL):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await loop.run_in_executor(executor, flush_read_states)
+        except Exception as e:
+            logging.error(f'Error flushing read states: {e}')
+
+
+def close():
+    # Queued indexing is dropped; reopened indexes catch up again.
+    executor.shutdown(wait=False, cancel_futures=True)
+    with lock:
+        indexing.clear()
+        for search_index in search_indexes.items.values():
+            search_index.flush()
+        search_indexes.close()
+        storage.close()
+
+
+atexit.register(close)
+
+
+def get_unread_counts(user_id: str):
+    """Return chat_id -> unread count for the public chat, the user's own
+    chat and every chat the user read in; chats without messages are left
+    out."""
+    with lock:
+        # Private messages to a user go to the chat named by its user_id,
+        # which has no read state until the user first reads there.
+        return unread_counters.counts(user_id, ['public', user_id])
+
+
+def encode_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(
+        struct.pack('!Q', seq)).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return struct.unpack('!Q', base64.urlsafe_b64decode(cursor + '='))[0]
+    except (binascii.Error, struct.error):
+        raise ValueError(f'Invalid cursor {cursor!r}.')
+
+
+def get_unread_page(user_id: str, chat_id: str = 'public',
+                    limit: int | None = UNREAD_LIMIT, cursor: str = None):
+    with lock:
+        total = storage.count(chat_id)
+        state = storage.read_state(chat_id, user_id)
+        seq = state.watermark if state is not None else 0
+        if cursor:
+            seq = max(seq, decode_cursor(cursor))
+        sparse = state.sparse if state is not None else ()
+        seqs = []
+        while seq < total and (limit is None or len(seqs) < limit):
+            if seq not in sparse:
+                seqs.append(seq)
+            seq += 1
+        rows = storage.read(chat_id, seqs[0], seqs[-1] + 1) if seqs else []
+
+    first = seqs[0] if seqs else 0
+    unread_messages = [rows[seq - first] for seq in seqs]
+    next_cursor = encode_cursor(seq) if seq < total else None
+    logging.debug('Found %d unread messages for user %s.',
+                  len(unread_messages), user_id)
+    return unread_messages, next_cursor
+
+
 def get_unread_messages(user_id: str, chat_id: str = 'public'):
-    chat_log_file = os.path.join(CHAT_LOG_DIR, f'{chat_id}.csv')
-    status_file = os.path.join(CHAT_LOG_DIR, f'{chat_id}_statuses.csv')
-
-    unread_messages = []
-    if os.path.isfile(chat_log_file):
-        with open(chat_log_file, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            all_messages = list(reader)
-    else:
-        logging.error(f'No chat log file found for chat_id {chat_id}.')
-        return unread_messages
-
-    read_statuses = []
-    if os.path.isfile(status_file):
-        with open(status_file, mode='r', newline='') as file:
-            reader = csv.DictReader(file)
-            read_statuses = list(reader)
-            print(read_statuses)
-
-    read_message_timestamps = {status['timestamp'] for status in read_statuses if user_id in status['user_id']}
-    for message in all_messages:
-        if message['timestamp'] not in read_message_timestamps:
-            unread_messages.append(message)
-
-    logging.info(f'Found {len(unread_messages)} unread messages for user {user_id}.')
-    return unread_messages
+    return get_unread_page(user_id, chat_id, limit=None)[0]
+
+
+def get_history_page(chat_id: str = 'public', before: str = None,
+                     after: str = None, limit: int = HISTORY_LIMIT,
+                     cursor: str = None):
+    """Return the newest ``limit`` messages strictly between ``after`` and
+    ``before``, oldest first, and the cursor of the page preceding them."""
+    with lock:
+        stop = storage.seek_timestamp(chat_id, before) if before \
+            else storage.count(chat_id)
+        if cursor:
+            stop = min(stop, decode_cursor(cursor))
+        floor = storage.seek_timestamp(
+            chat_id, us_to_timestamp(timestamp_to_us(after) + 1)) \
+            if after else 0
+        start = max(stop - limit, floor)
+        rows = storage.read(chat_id, start, stop) if start < stop else []
+
+    next_cursor = encode_cursor(start) if start > floor else None
+    logging.debug('Found %d history messages in chat %s.', len(rows), chat_id)
+    return rows, next_cursor
+
+
+def search_messages(chat_id: str, query: str, limit: int = SEARCH_LIMIT):
+    """Return the newest ``limit`` messages holding every term of
+    ``query``, oldest first.
+
+    A backlog of up to a batch of unindexed messages is indexed first; a
+    longer one is left to the background and only indexed messages match.
+    """
+    with lock:
+        search_index = search_indexes.open(chat_id)
+        if not search_index.catch_up(storage.count(chat_id), batches=1):
+            schedule_indexing(chat_id)
+        # Reads runs of adjacent matches together.
+        runs = []
+        for seq in reversed(search_index.search(query, limit)):
+            if runs and runs[-1][1] == seq:
+                runs[-1][1] += 1
+            else:
+                runs.append([seq, seq + 1])
+        rows = [row for start, stop in runs
+                for row in storage.read(chat_id, start, stop)]
+    logging.debug('Found %d messages matching %r in chat %s.', len(rows),
+                  query, chat_id)
+    return rows
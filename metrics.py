@@ -0,0 +1,115 @@
+import bisect
+import time
+
+# Upper bounds of the latency histogram buckets, in seconds.
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+                   0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, float('inf'))
+
+
+class Histogram:
+    __slots__ = ('bounds', 'counts', 'count', 'total')
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        self.counts = [0] * len(bounds)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.total += value
+
+    def quantile(self, q: float) -> float:
+        # Upper bound of the bucket holding the q-th observation.
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            seen += count
+            if seen >= rank and count:
+                return bound
+        return 0.0
+
+    def as_dict(self) -> dict:
+        return {'count': self.count,
+                'sum': round(self.total, 6),
+                'p50': self.quantile(0.5),
+                'p99': self.quantile(0.99),
+                'buckets': {str(bound): count for bound, count
+                            in zip(self.bounds, self.counts) if count}}
+
+
+class RouteMetrics:
+    __slots__ = ('requests', 'errors', 'latency')
+
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.latency = Histogram()
+
+
+class Metrics:
+
+    def __init__(self):
+        self.started = time.time()
+        self.routes = {}
+        self.counters = {'bytes_in': 0, 'bytes_out': 0, 'connections': 0}
+        self.active_connections = 0
+        self.send_latency = Histogram()
+        # Name -> callable, sampled whenever the metrics are read.
+        self.gauges = {}
+
+    def route(self, route: str) -> RouteMetrics:
+        metrics = self.routes.get(route)
+        if metrics is None:
+            metrics = self.routes[route] = RouteMetrics()
+        return metrics
+
+    def observe_request(self, route: str, elapsed: float, error=False):
+        metrics = self.route(route)
+        metrics.requests += 1
+        metrics.errors += error
+        metrics.latency.observe(elapsed)
+
+    def increment(self, counter: str, value: int = 1):
+        self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def snapshot(self) -> dict:
+        return {'uptime': round(time.time() - self.started, 3),
+                'active_connections': self.active_connections,
+                'counters': dict(self.counters),
+                'gauges': {name: gauge() for name, gauge
+                           in self.gauges.items()},
+                'send_latency': self.send_latency.as_dict(),
+                'routes': {route: {'requests': metrics.requests,
+                                   'errors': metrics.errors,
+                                   'latency': metrics.latency.as_dict()}
+                           for route, metrics in self.routes.items()}}
+
+    def render_text(self) -> str:
+        lines = [f'uptime_seconds {time.time() - self.started:.3f}',
+                 f'active_connections {self.active_connections}']
+        lines += [f'{name}_total {value}'
+                  for name, value in self.counters.items()]
+        lines += [f'{name} {gauge()}' for name, gauge in self.gauges.items()]
+        histograms = [('send_latency_seconds', '', self.send_latency)]
+        for route, metrics in self.routes.items():
+            lines.append(f'requests_total{{route="{route}"}} '
+                         f'{metrics.requests}')
+            lines.append(f'errors_total{{route="{route}"}} {metrics.errors}')
+            histograms.append(('request_latency_seconds',
+                               f'route="{route}",', metrics.latency))
+        for name, labels, histogram in histograms:
+            cumulative = 0
+            for bound, count in zip(histogram.bounds, histogram.counts):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else bound
+                lines.append(f'{name}_bucket{{{labels}le="{le}"}} '
+                             f'{cumulative}')
+            labels = f'{{{labels.rstrip(",")}}}' if labels else ''
+            lines.append(f'{name}_count{labels} {histogram.count}')
+            lines.append(f'{name}_sum{labels} {histogram.total:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
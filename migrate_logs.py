@@ -0,0 +1,79 @@
+import argparse
+import csv
+import logging
+import os
+
+import messages_manager as mm
+
+logging.basicConfig(level=logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
+BATCH_SIZE = 10000
+
+
+def legacy_chats():
+    for name in sorted(os.listdir(mm.CHAT_LOG_DIR)):
+        if name.endswith('.csv') and not name.endswith('_statuses.csv'):
+            yield name[:-len('.csv')]
+
+
+def migrate_chat(chat_id: str):
+    chat_log_file = os.path.join(mm.CHAT_LOG_DIR, f'{chat_id}.csv')
+    count = mm.storage.count(chat_id)
+    if count:
+        logging.error(f'Chat {chat_id} already has {count} '
+                      'messages in the log, skipping.')
+        return 0
+
+    migrated = 0
+    with open(chat_log_file, mode='r', newline='') as file:
+        batch = []
+        for row in csv.DictReader(file):
+            batch.append([row['timestamp'], row['user_id'], row['message']])
+            if len(batch) >= BATCH_SIZE:
+                mm.storage.append(chat_id, batch)
+                migrated += len(batch)
+                batch = []
+        if batch:
+            mm.storage.append(chat_id, batch)
+            migrated += len(batch)
+    mm.storage.sync([chat_id])
+    os.replace(chat_log_file, f'{chat_log_file}.migrated')
+    logging.info(f'Migrated {migrated} messages of chat {chat_id}.')
+    return migrated
+
+
+def migrate_statuses(chat_id: str):
+    status_file = os.path.join(mm.CHAT_LOG_DIR, f'{chat_id}_statuses.csv')
+    if not os.path.isfile(status_file):
+        return 0
+
+    acks = {}
+    with open(status_file, mode='r', newline='') as file:
+        for status in csv.DictReader(file):
+            seq = mm.storage.find_timestamp(chat_id, status['timestamp'])
+            if seq is not None:
+                acks.setdefault(status['user_id'], []).append(seq)
+    for user_id, seqs in acks.items():
+        mm.storage.ack(chat_id, user_id, sorted(seqs))
+    mm.storage.flush_reads()
+    os.replace(status_file, f'{status_file}.migrated')
+    logging.info(f'Migrated read statuses of {len(acks)} users '
+                 f'of chat {chat_id}.')
+    return len(acks)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Migrate {chat_id}.csv logs and read statuses to the '
+                    'configured storage backend.')
+    parser.add_argument('chat_ids', nargs='*',
+                        help='chats to migrate (default: every CSV log)')
+    args = parser.parse_args()
+    for chat_id in args.chat_ids or list(legacy_chats()):
+        migrate_chat(chat_id)
+        migrate_statuses(chat_id)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+import os
+import struct
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+MAX_FRAME_SIZE = int(os.getenv('MAX_FRAME_SIZE', 1 << 20))
+TEXT_PROTOCOL = os.getenv('TEXT_PROTOCOL', 'on') == 'on'
+
+HEADER = struct.Struct('!I')
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(message) -> bytes:
+    if isinstance(message, str):
+        message = message.encode()
+    return HEADER.pack(len(message)) + message
+
+
+class RequestParser:
+    """Incremental request parser for one connection.
+
+    Requests are framed like responses: a ``!I`` length header followed by
+    the request text. A connection whose first byte is printable is treated
+    as a legacy text client instead, where every line (or every read
+    without a newline) is one whitespace separated request.
+    """
+
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE,
+                 text_protocol=TEXT_PROTOCOL):
+        self.max_frame_size = max_frame_size
+        self.text_protocol = text_protocol
+        self.framed = None
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list:
+        self.buffer += data
+        if self.framed is None and self.buffer:
+            self.framed = self.buffer[0] < 0x20
+            if not self.framed and not self.text_protocol:
+                raise FrameError('Requests have to be length-prefixed.')
+        if self.framed:
+            return self._frames()
+        return self._lines()
+
+    def _frames(self):
+        requests = []
+        position = 0
+        while len(self.buffer) - position >= HEADER.size:
+            length = HEADER.unpack_from(self.buffer, position)[0]
+            if length > self.max_frame_size:
+                raise FrameError(f'Request of {length} bytes exceeds '
+                                 f'{self.max_frame_size} bytes.')
+            end = position + HEADER.size + length
+            if len(self.buffer) < end:
+                break
+            requests.append(self.buffer[position + HEADER.size:end]
+                            .decode(errors='replace'))
+            position = end
+        del self.buffer[:position]
+        return requests
+
+    def _lines(self):
+        lines = self.buffer.decode(errors='replace').splitlines()
+        self.buffer.clear()
+        return [line for line in lines if line.strip()]
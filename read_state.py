@@ -0,0 +1,255 @@
+import csv
+import fcntl
+import logging
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+READ_STATE_COMPACT_EVERY = int(os.getenv('READ_STATE_COMPACT_EVERY', 10000))
+# Acks are merged in memory and journaled this often; 0 writes each one.
+READ_ACK_FLUSH_INTERVAL = float(os.getenv('READ_ACK_FLUSH_INTERVAL', 0.5))
+
+
+class ReadState:
+    __slots__ = ('watermark', 'sparse')
+
+    def __init__(self, watermark: int = 0, sparse=None):
+        # Every message with seq < watermark is read; sparse holds the
+        # out-of-order acks above the watermark.
+        self.watermark = watermark
+        self.sparse = sparse if sparse is not None else set()
+
+    def is_read(self, seq: int) -> bool:
+        return seq < self.watermark or seq in self.sparse
+
+    def count(self) -> int:
+        return self.watermark + len(self.sparse)
+
+    def ack(self, seq: int) -> bool:
+        if self.is_read(seq):
+            return False
+        if seq == self.watermark:
+            self.watermark += 1
+            while self.watermark in self.sparse:
+                self.sparse.remove(self.watermark)
+                self.watermark += 1
+        else:
+            self.sparse.add(seq)
+        return True
+
+    def advance(self, watermark: int) -> bool:
+        # Cumulative ack: every message with seq < watermark is read.
+        if watermark <= self.watermark:
+            return False
+        self.watermark = watermark
+        while self.watermark in self.sparse:
+            self.watermark += 1
+        self.sparse = {seq for seq in self.sparse if seq > self.watermark}
+        return True
+
+    def merge(self, other: 'ReadState'):
+        # advance folds the sparse seqs the new watermark reaches.
+        self.advance(other.watermark)
+        for seq in other.sparse:
+            self.ack(seq)
+
+
+class ReadStateStore:
+    """Read positions of every user in one chat.
+
+    Acks update the states in memory at once. Every ``flush`` journals one
+    cumulative entry per user acked since the previous flush plus the
+    out-of-order acks still above it, and the journal is folded into a
+    snapshot once it holds ``compact_every`` entries. With ``shared`` files
+    every journal write holds the journal's lock, and reads first apply the
+    entries other processes appended since the offset read up to.
+    """
+
+    def __init__(self, directory, chat_id,
+                 compact_every=READ_STATE_COMPACT_EVERY,
+                 write_through=not READ_ACK_FLUSH_INTERVAL, shared=False):
+        self.snapshot_path = os.path.join(directory, f'{chat_id}.reads')
+        self.journal_path = os.path.join(directory, f'{chat_id}.reads.log')
+        self.compact_every = compact_every
+        self.write_through = write_through
+        # Other worker processes journal acks to the same files.
+        self.shared = shared
+        self.journal = open(self.journal_path, mode='a')
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self.states, self.journal_entries = self._load()
+            self._remember_files()
+        finally:
+            self._lock(fcntl.LOCK_UN)
+        # user_id -> out-of-order seqs acked since the last flush.
+        self.pending = {}
+
+    def _lock(self, operation):
+        if self.shared:
+            fcntl.flock(self.journal.fileno(), operation)
+
+    def _snapshot_id(self):
+        try:
+            stat = os.stat(self.snapshot_path)
+        except FileNotFoundError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _remember_files(self):
+        # The journal is read up to here; a compaction replaces the snapshot
+        # and truncates the journal, which starts reading over.
+        self.snapshot_id = self._snapshot_id()
+        self.journal_offset = os.fstat(self.journal.fileno()).st_size
+
+    @staticmethod
+    def _apply(states: dict, lines, path) -> int:
+        applied = 0
+        for line in lines:
+            try:
+                user_id, seq = line.split()
+                state = states.setdefault(user_id, ReadState())
+                if seq.startswith('<'):
+                    state.advance(int(seq[1:]))
+                else:
+                    state.ack(int(seq))
+            except ValueError:
+                logging.error(f'Skipping torn journal entry {line!r} '
+                              f'in {path}.')
+                continue
+            applied += 1
+        return applied
+
+    def _load(self):
+        states = {}
+        journal_entries = 0
+        if os.path.isfile(self.snapshot_path):
+            with open(self.snapshot_path, mode='r', newline='') as file:
+                for user_id, watermark, sparse in csv.reader(file):
+                    states[user_id] = ReadState(
+                        int(watermark),
+                        {int(seq) for seq in sparse.split('/') if seq})
+        if os.path.isfile(self.journal_path):
+            with open(self.journal_path, mode='r') as file:
+                journal_entries = self._apply(states, file, self.journal_path)
+        return states, journal_entries
+
+    def _merge(self, states: dict):
+        for user_id, state in states.items():
+            self.get_or_create(user_id).merge(state)
+
+    def _catch_up(self):
+        if self._snapshot_id() != self.snapshot_id or \
+                os.fstat(self.journal.fileno()).st_size < self.journal_offset:
+            states, self.journal_entries = self._load()
+            self._merge(states)
+            self._remember_files()
+            return
+        with open(self.journal_path, mode='rb') as file:
+            file.seek(self.journal_offset)
+            data = file.read()
+        # Only whole lines; a partial one is read again with its end.
+        data = data[:data.rfind(b'\n') + 1]
+        self.journal_offset += len(data)
+        self.journal_entries += self._apply(
+            self.states, data.decode().splitlines(), self.journal_path)
+
+    def refresh(self):
+        """Apply the acks other processes journaled since the last
+        refresh."""
+        if not self.shared or (
+                self._snapshot_id() == self.snapshot_id and
+                os.fstat(self.journal.fileno()).st_size ==
+                self.journal_offset):
+            return
+        self._lock(fcntl.LOCK_SH)
+        try:
+            self._catch_up()
+        finally:
+            self._lock(fcntl.LOCK_UN)
+
+    def get(self, user_id: str):
+        self.refresh()
+        return self.states.get(user_id)
+
+    def get_or_create(self, user_id: str) -> ReadState:
+        state = self.states.get(user_id)
+        if state is None:
+            state = self.states[user_id] = ReadState()
+        return state
+
+    def ack(self, user_id: str, seqs) -> int:
+        state = self.get_or_create(user_id)
+        acked = [seq for seq in seqs if state.ack(seq)]
+        if acked:
+            self.pending.setdefault(user_id, set()).update(acked)
+            if self.write_through:
+                self.flush()
+        return len(acked)
+
+    def ack_upto(self, user_id: str, watermark: int) -> bool:
+        advanced = self.get_or_create(user_id).advance(watermark)
+        if advanced:
+            self.pending.setdefault(user_id, set())
+            if self.write_through:
+                self.flush()
+        return advanced
+
+    def flush(self) -> int:
+        if not self.pending:
+            return 0
+        pending, self.pending = self.pending, {}
+        self._lock(fcntl.LOCK_EX)
+        try:
+            if self.shared:
+                self._catch_up()
+            lines = []
+            for user_id, seqs in pending.items():
+                state = self.states[user_id]
+                lines.append(f'{user_id} <{state.watermark}\n')
+                lines.extend(f'{user_id} {seq}\n' for seq in sorted(seqs)
+                             if seq >= state.watermark)
+            self.journal.write(''.join(lines))
+            self.journal.flush()
+            self.journal_offset = os.fstat(self.journal.fileno()).st_size
+            self.journal_entries += len(lines)
+            if self.journal_entries >= self.compact_every:
+                self._compact()
+        finally:
+            self._lock(fcntl.LOCK_UN)
+        return len(lines)
+
+    def compact(self):
+        self._lock(fcntl.LOCK_EX)
+        try:
+            self._compact()
+        finally:
+            self._lock(fcntl.LOCK_UN)
+
+    def _compact(self):
+        # Other worker processes may share the files: merge whatever they
+        # persisted before replacing the snapshot and truncating the journal.
+        self._merge(self._load()[0])
+        temporary_path = f'{self.snapshot_path}.tmp'
+        with open(temporary_path, mode='w', newline='') as file:
+            writer = csv.writer(file)
+            for user_id, state in self.states.items():
+                writer.writerow([user_id, state.watermark,
+                                 '/'.join(map(str, sorted(state.sparse)))])
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.snapshot_path)
+        self.journal.truncate(0)
+        self.journal_entries = 0
+        self._remember_files()
+        # The snapshot holds the acks that were waiting for a flush.
+        self.pending = {}
+        logging.info(f'Compacted read states into {self.snapshot_path}.')
+
+    def open_files(self) -> int:
+        return 1
+
+    def close(self):
+        self.flush()
+        self.journal.close()
@@ -1,30 +1,135 @@
+import argparse
 import asyncio
 import logging
 import os
+import signal
+import socket
 import subprocess
+import sys
 
 from dotenv import load_dotenv
-from multiprocessing import freeze_support
+from multiprocessing import Process, freeze_support
 
 load_dotenv()
 
+# Per-request logging is only emitted with VERBOSE_LOGGING=on.
+logging.basicConfig(level=logging.DEBUG
+                    if os.getenv('VERBOSE_LOGGING') == 'on' else logging.INFO,
+                    format='%(asctime)s - %(levelname)s - %(message)s')
+
 HOST = os.getenv('HOST')
 PORT = os.getenv('PORT')
+WORKERS = int(os.getenv('WORKERS', 1))
+
 
+def reuse_port_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((HOST, int(PORT)))
+    sock.listen(socket.SOMAXCONN)
+    sock.setblocking(False)
+    return sock
 
-async def main():
-    server_socket = await asyncio.start_server(
-        lambda reader, writer: server.run(reader, writer),
-        HOST, int(PORT))
+
+async def main(sock=None, bus_path=None):
+    snapshot_task = None
+    if server.SNAPSHOT_INTERVAL:
+        # Before serving, so that resuming clients find their sessions.
+        server.state_snapshot.restore()
+        snapshot_task = asyncio.create_task(
+            server.state_snapshot.write_periodically(server.mm.executor))
+    if bus_path:
+        import bus
+        bus_client = bus.BusClient(bus_path)
+        await bus_client.connect()
+        bus.attach(bus_client)
+    if sock is None:
+        server_socket = await asyncio.start_server(
+            lambda reader, writer: server.run(reader, writer),
+            HOST, int(PORT))
+    else:
+        server_socket = await asyncio.start_server(
+            lambda reader, writer: server.run(reader, writer),
+            sock=sock)
     logging.info(f'Socket is bound to {HOST}:{PORT}.')
+    export_task = None
+    if sessions.SESSIONS_EXPORT_PATH:
+        export_task = asyncio.create_task(sessions.export_sessions())
+    timer_task = asyncio.create_task(server.wheel.run())
+    lag_task = asyncio.create_task(server.admission.monitor_lag())
+    flush_task = None
+    if server.mm.READ_ACK_FLUSH_INTERVAL:
+        flush_task = asyncio.create_task(
+            server.mm.flush_read_states_periodically())
     async with server_socket:
         await server_socket.serve_forever()
 
 
+def shutdown():
+    # Called explicitly: worker processes leave through os._exit, which
+    # skips atexit handlers.
+    if server.SNAPSHOT_INTERVAL:
+        server.state_snapshot.close()
+    server.mm.close()
+
+
+def worker(number, bus_path):
+    global server, sessions
+    import message_log
+    import snapshot
+    message_log.SHARED = True
+    snapshot.SNAPSHOT_PATH += f'.{number}'
+    import server
+    import sessions
+    if sessions.SESSIONS_EXPORT_PATH:
+        sessions.SESSIONS_EXPORT_PATH += f'.{number}'
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    try:
+        asyncio.run(main(reuse_port_socket(), bus_path))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        shutdown()
+
+
+def run_workers(workers):
+    import bus
+    if os.path.exists(bus.BUS_PATH):
+        os.unlink(bus.BUS_PATH)
+    bus_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    bus_socket.bind(bus.BUS_PATH)
+    bus_socket.listen()
+    processes = [Process(target=worker, args=(number, bus.BUS_PATH))
+                 for number in range(workers)]
+    for process in processes:
+        process.start()
+    logging.info(f'Started {workers} workers on {HOST}:{PORT}.')
+    try:
+        asyncio.run(bus.BusHub().serve(bus_socket))
+    finally:
+        for process in processes:
+            process.terminate()
+            process.join()
+        os.unlink(bus.BUS_PATH)
+
+
 if __name__ == '__main__':
     freeze_support()
-    import server
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--workers', type=int, default=WORKERS,
+                        help='number of acceptor processes sharing the port')
+    args = parser.parse_args()
     try:
-        asyncio.run(main())
+        if args.workers > 1:
+            run_workers(args.workers)
+        else:
+            import server
+            import sessions
+            try:
+                asyncio.run(main())
+            finally:
+                shutdown()
     except KeyboardInterrupt:
         subprocess.run(['npx', 'kill-port', PORT])
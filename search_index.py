@@ -0,0 +1,487 @@
+import bisect
+import fcntl
+import json
+import math
+import mmap
+import os
+import re
+import struct
+import threading
+
+from contextlib import contextmanager
+from dotenv import load_dotenv
+
+from codec import read_varint, write_varint
+
+load_dotenv()
+
+# Postings kept in memory before they are written out as a segment.
+SEARCH_FLUSH_POSTINGS = int(os.getenv('SEARCH_FLUSH_POSTINGS', 100000))
+# Segments of one size tier are merged this many at a time.
+SEARCH_MERGE_FACTOR = int(os.getenv('SEARCH_MERGE_FACTOR', 4))
+# Seqs per posting block; every block is reachable through the skip table.
+POSTING_BLOCK = 128
+# Messages read from the chat at a time while catching up; the storage lock
+# is held for a batch.
+CATCH_UP_BATCH = 2000
+
+# Attempts at loading a manifest whose segments merges keep replacing.
+MANIFEST_RETRIES = 3
+
+TOKEN = re.compile(r'\w+')
+# Longer terms are indexed and queried by their prefix.
+MAX_TERM_LENGTH = 64
+# Term dictionary entry: term length, then (offset, byte length, count) of
+# its posting list in the .postings file.
+TERM_ENTRY = struct.Struct('!QII')
+TERM_LENGTH = struct.Struct('!H')
+# Skip table entry: first seq of a block and its offset in the block data.
+SKIP_ENTRY = struct.Struct('!QI')
+
+
+def tokenize(text: str) -> set:
+    return {term[:MAX_TERM_LENGTH] for term in TOKEN.findall(text.lower())}
+
+
+def encode_postings(seqs) -> bytes:
+    """Skip table followed by blocks of varint deltas; the first seq of
+    every block is only stored in the skip table."""
+    skips = bytearray()
+    data = bytearray()
+    for start in range(0, len(seqs), POSTING_BLOCK):
+        block = seqs[start:start + POSTING_BLOCK]
+        skips += SKIP_ENTRY.pack(block[0], len(data))
+        previous = block[0]
+        for seq in block[1:]:
+            write_varint(data, seq - previous)
+            previous = seq
+    return bytes(skips + data)
+
+
+class MemoryPostings:
+    __slots__ = ('seqs',)
+
+    def __init__(self, seqs):
+        self.seqs = seqs
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def block_firsts(self):
+        return self.seqs[::POSTING_BLOCK]
+
+    def block(self, number):
+        return self.seqs[number * POSTING_BLOCK:(number + 1) * POSTING_BLOCK]
+
+
+class SegmentPostings:
+    """Posting list of one term read straight from a memory-mapped
+    segment."""
+
+    __slots__ = ('data', 'offset', 'length', 'count', 'skips')
+
+    def __init__(self, data, offset, length, count):
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.count = count
+        blocks = -(-count // POSTING_BLOCK)
+        self.skips = list(SKIP_ENTRY.iter_unpack(
+            data[offset:offset + blocks * SKIP_ENTRY.size]))
+
+    def __len__(self):
+        return self.count
+
+    def block_firsts(self):
+        return [first for first, _ in self.skips]
+
+    def block(self, number):
+        first, start = self.skips[number]
+        base = self.offset + len(self.skips) * SKIP_ENTRY.size
+        size = min(POSTING_BLOCK, self.count - number * POSTING_BLOCK)
+        position = base + start
+        seqs = [first]
+        for _ in range(size - 1):
+            delta, position = read_varint(self.data, position)
+            seqs.append(seqs[-1] + delta)
+        return seqs
+
+
+class TermPostings:
+    """Posting lists of one term across segments, in seq order."""
+
+    def __init__(self, parts):
+        self.parts = [part for part in parts if len(part)]
+        self.firsts = []
+        self.locations = []
+        for part in self.parts:
+            firsts = part.block_firsts()
+            self.firsts.extend(firsts)
+            self.locations.extend((part, number)
+                                  for number in range(len(firsts)))
+        self.cache = {}
+
+    def __len__(self):
+        return sum(map(len, self.parts))
+
+    def block(self, number):
+        seqs = self.cache.get(number)
+        if seqs is None:
+            part, local = self.locations[number]
+            seqs = self.cache[number] = part.block(local)
+        return seqs
+
+    def __contains__(self, seq):
+        number = bisect.bisect_right(self.firsts, seq) - 1
+        if number < 0:
+            return False
+        seqs = self.block(number)
+        position = bisect.bisect_left(seqs, seq)
+        return position < len(seqs) and seqs[position] == seq
+
+    def newest(self):
+        for number in reversed(range(len(self.firsts))):
+            yield from reversed(self.block(number))
+
+
+class Segment:
+    def __init__(self, directory, name):
+        self.name = name
+        self.terms = {}
+        path = os.path.join(directory, f'{name}.terms')
+        with open(path, 'rb') as file:
+            data = file.read()
+        position = 0
+        while position < len(data):
+            length, = TERM_LENGTH.unpack_from(data, position)
+            position += TERM_LENGTH.size
+            term = data[position:position + length].decode()
+            position += length
+            self.terms[term] = TERM_ENTRY.unpack_from(data, position)
+            position += TERM_ENTRY.size
+        with open(os.path.join(directory, f'{name}.postings'), 'rb') as file:
+            self.data = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) \
+                if os.fstat(file.fileno()).st_size else b''
+
+    def postings(self, term):
+        entry = self.terms.get(term)
+        if entry is None:
+            return None
+        offset, length, count = entry
+        return SegmentPostings(self.data, offset, length, count)
+
+    def seqs(self, term):
+        postings = self.postings(term)
+        seqs = []
+        for number in range(len(postings.skips)):
+            seqs.extend(postings.block(number))
+        return seqs
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def write_segment(directory, name, postings: dict):
+    terms = bytearray()
+    data = bytearray()
+    for term in sorted(postings):
+        encoded = encode_postings(postings[term])
+        term_bytes = term.encode()
+        terms += TERM_LENGTH.pack(len(term_bytes)) + term_bytes
+        terms += TERM_ENTRY.pack(len(data), len(encoded), len(postings[term]))
+        data += encoded
+    for suffix, content in (('postings', data), ('terms', terms)):
+        path = os.path.join(directory, f'{name}.{suffix}')
+        with open(f'{path}.tmp', 'wb') as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(f'{path}.tmp', path)
+
+
+def read_manifest(path):
+    try:
+        with open(path, mode='r') as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'segments': [], 'indexed': 0}
+
+
+def write_manifest(path, segments: list, indexed: int):
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, mode='w') as file:
+        json.dump({'segments': segments, 'indexed': indexed}, file)
+    os.replace(temporary_path, path)
+
+
+def segment_end(name: str) -> int:
+    # Segments are named by the seq they end at.
+    return int(name.partition('.')[0])
+
+
+def drop_below(postings: dict, seq: int) -> dict:
+    kept = {}
+    for term, seqs in postings.items():
+        seqs = seqs[bisect.bisect_left(seqs, seq):]
+        if seqs:
+            kept[term] = seqs
+    return kept
+
+
+class SearchIndex:
+    """Inverted index of one chat: term -> seqs of the messages holding it.
+
+    New messages are indexed in memory and written out as immutable
+    segments of delta-encoded posting lists, which are memory-mapped for
+    queries. The manifest lists the segments and the number of messages
+    they cover; ``read(start, stop)`` supplies the messages past it, so that
+    messages lost in a crash or appended by another worker are indexed
+    before they are searched.
+
+    ``add``, ``catch_up`` and queries run under ``lock``. ``flush`` and
+    ``merge`` take it only to swap postings and segments in and out, and
+    write segments under the directory's file lock instead.
+    """
+
+    def __init__(self, directory, read, lock,
+                 flush_postings=SEARCH_FLUSH_POSTINGS,
+                 merge_factor=SEARCH_MERGE_FACTOR):
+        self.directory = directory
+        self.read = read
+        self.lock = lock
+        self.flush_postings = flush_postings
+        self.merge_factor = merge_factor
+        os.makedirs(directory, exist_ok=True)
+        self.manifest_path = os.path.join(directory, 'manifest')
+        self.lock_file = open(os.path.join(directory, 'lock'), 'a+b')
+        self.write_lock = threading.Lock()
+        self.segments = []
+        self.manifest_mtime = None
+        # Messages below ``indexed`` are in segments, the ones from there to
+        # ``end`` in memory: in ``frozen`` while a flush writes them out,
+        # then in ``memory``.
+        self.indexed = 0
+        self.end = 0
+        self.frozen = {}
+        self.memory = {}
+        self.memory_postings = 0
+        self.closed = False
+        self.refresh()
+
+    def refresh(self):
+        # Without the lock: a merge replaces the manifest before it unlinks
+        # the segments it merged, so a segment gone missing means that a
+        # newer manifest is there to load.
+        for attempt in range(MANIFEST_RETRIES):
+            try:
+                self._load_manifest()
+                return
+            except FileNotFoundError:
+                if attempt == MANIFEST_RETRIES - 1:
+                    raise
+                self.manifest_mtime = None
+
+    @contextmanager
+    def _writing(self):
+        # One writer at a time among the threads of this process, then
+        # among the processes sharing the directory; yields False once the
+        # index is closed.
+        with self.write_lock:
+            if self.closed:
+                yield False
+                return
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_EX)
+            try:
+                yield True
+            finally:
+                fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _reload(self):
+        with self.lock:
+            if not self.closed:
+                self.manifest_mtime = None
+                self.refresh()
+
+    def _load_manifest(self):
+        try:
+            mtime = os.stat(self.manifest_path).st_mtime_ns
+        except FileNotFoundError:
+            return
+        if mtime == self.manifest_mtime:
+            return
+        manifest = read_manifest(self.manifest_path)
+        loaded = {segment.name: segment for segment in self.segments}
+        self.segments = [loaded.pop(name, None) or
+                         Segment(self.directory, name)
+                         for name in manifest['segments']]
+        for segment in loaded.values():
+            segment.close()
+        self.manifest_mtime = mtime
+        self.indexed = manifest['indexed']
+        # Another worker, or a flush of this one, may have written some of
+        # them already.
+        if self.frozen:
+            self.frozen = drop_below(self.frozen, self.indexed)
+        if self.memory:
+            self.memory = drop_below(self.memory, self.indexed)
+            self.memory_postings = sum(map(len, self.memory.values()))
+        self.end = max(self.end, self.indexed)
+
+    def add(self, first_seq: int, messages: list):
+        """Index ``messages`` stored from ``first_seq`` on; past a gap they
+        are left to ``catch_up``, which reads them with the gap."""
+        if first_seq > self.end:
+            self.refresh()
+            if first_seq > self.end:
+                return
+        for seq, message in enumerate(messages, first_seq):
+            if seq < self.end:
+                continue
+            for term in tokenize(message):
+                self.memory.setdefault(term, []).append(seq)
+                self.memory_postings += 1
+            self.end = seq + 1
+
+    def full(self) -> bool:
+        """Whether the postings in memory are due for a flush."""
+        return self.memory_postings >= self.flush_postings
+
+    def catch_up(self, count: int, batches: int = None) -> bool:
+        """Index the messages from ``end`` to ``count`` from the chat, at
+        most ``batches`` batches of them; return whether all are."""
+        self.refresh()
+        while self.end < count and batches != 0:
+            stop = min(count, self.end + CATCH_UP_BATCH)
+            self.add(self.end, [row['message']
+                                for row in self.read(self.end, stop)])
+            if batches is not None:
+                batches -= 1
+        return self.end >= count
+
+    def flush(self):
+        """Write the postings in memory out as a segment."""
+        with self.lock:
+            if self.closed or self.frozen or not self.memory:
+                return
+            # They stay searchable while the segment is written; loading the
+            # manifest that lists it drops them.
+            self.frozen, stop = self.memory, self.end
+            self.memory, self.memory_postings = {}, 0
+            postings = self.frozen
+        try:
+            with self._writing() as writing:
+                if not writing:
+                    return
+                manifest = read_manifest(self.manifest_path)
+                postings = drop_below(postings, manifest['indexed'])
+                if stop > manifest['indexed']:
+                    name = f'{stop:020d}'
+                    if postings:
+                        write_segment(self.directory, name, postings)
+                    write_manifest(self.manifest_path, manifest['segments'] +
+                                   ([name] if postings else []), stop)
+        except BaseException:
+            with self.lock:
+                self._thaw()
+            raise
+        self._reload()
+
+    def _thaw(self):
+        # Puts postings back after a failed flush, ahead of newer ones.
+        for term, seqs in self.frozen.items():
+            self.memory[term] = seqs + self.memory.get(term, [])
+        self.frozen = {}
+        self.memory_postings = sum(map(len, self.memory.values()))
+
+    @staticmethod
+    def _tier(segment, factor: int) -> int:
+        return int(math.log(max(len(segment.data), 1), factor))
+
+    def _merge_run(self, segments: list):
+        # The newest run of ``merge_factor`` adjacent segments of one size
+        # tier, so that a posting is rewritten about once per tier rather
+        # than at every merge.
+        factor = self.merge_factor
+        tiers = [self._tier(segment, factor) for segment in segments]
+        for first in reversed(range(len(segments) - factor + 1)):
+            if len(set(tiers[first:first + factor])) == 1:
+                return first, first + factor
+        return None
+
+    def merge(self) -> bool:
+        """Merge one run of segments of a size tier; return whether one
+        was merged."""
+        with self._writing() as writing:
+            if not writing:
+                return False
+            manifest = read_manifest(self.manifest_path)
+            segments = [Segment(self.directory, name)
+                        for name in manifest['segments']]
+            try:
+                run = self._merge_run(segments)
+                if run is None:
+                    return False
+                first, stop = run
+                postings = {}
+                for segment in segments[first:stop]:
+                    for term in segment.terms:
+                        postings.setdefault(term, []).extend(
+                            segment.seqs(term))
+                start = segment_end(segments[first - 1].name) if first else 0
+                name = f'{segment_end(segments[stop - 1].name):020d}.' \
+                       f'{start:020d}'
+                write_segment(self.directory, name, postings)
+                names = [segment.name for segment in segments]
+                write_manifest(self.manifest_path,
+                               names[:first] + [name] + names[stop:],
+                               manifest['indexed'])
+            finally:
+                for segment in segments:
+                    segment.close()
+            # Processes still mapping the merged segments keep them.
+            for merged in names[first:stop]:
+                for suffix in ('terms', 'postings'):
+                    os.unlink(os.path.join(self.directory,
+                                           f'{merged}.{suffix}'))
+        self._reload()
+        return True
+
+    def postings(self, term: str) -> TermPostings:
+        parts = [segment.postings(term) for segment in self.segments]
+        parts = [part for part in parts if part is not None]
+        for postings in (self.frozen, self.memory):
+            if term in postings:
+                parts.append(MemoryPostings(postings[term]))
+        return TermPostings(parts)
+
+    def search(self, query: str, limit: int) -> list:
+        """Return the seqs of the newest ``limit`` messages holding every
+        term of the query, newest first."""
+        terms = tokenize(query)
+        if not terms:
+            return []
+        lists = sorted((self.postings(term) for term in terms), key=len)
+        found = []
+        # Walks the rarest term from the newest message back and looks the
+        # others up through their skip tables.
+        for seq in lists[0].newest():
+            if all(seq in postings for postings in lists[1:]):
+                found.append(seq)
+                if len(found) >= limit:
+                    break
+        return found
+
+    def open_files(self) -> int:
+        # Every memory-mapped segment keeps a descriptor of its own.
+        return 1 + sum(isinstance(segment.data, mmap.mmap)
+                       for segment in self.segments)
+
+    def close(self):
+        # Postings not flushed yet are dropped rather than written out as a
+        # tiny segment; catching up indexes their messages again.
+        self.closed = True
+        for segment in self.segments:
+            segment.close()
+        with self.write_lock:
+            self.lock_file.close()
@@ -2,25 +2,80 @@ import asyncio
 import json
 import logging
 import os
-import struct
-import threading
+import socket
+import time
 
 from dotenv import load_dotenv
-from socket import error as SocketError
 
+import messages_manager as mm
 import sessions
-from urls import urls
+from admission import Admission
+from broadcast import broadcaster
+from codec import encode
+from metrics import metrics
+from protocol import HEADER, FrameError, RequestParser, encode_frame
+from snapshot import SNAPSHOT_INTERVAL, SNAPSHOT_PATH, Snapshot
+from timer_wheel import wheel
+from urls import limits, urls
 
 load_dotenv()
 
 HOST = os.getenv('HOST')
 PORT = os.getenv('PORT')
+READ_SIZE = int(os.getenv('READ_SIZE', 65536))
+# Connections without a frame for IDLE_TIMEOUT seconds are closed; clients
+# send GET /ping to stay alive. 0 disables the timeout.
+IDLE_TIMEOUT = float(os.getenv('IDLE_TIMEOUT', 120))
+KEEPALIVE_IDLE = int(os.getenv('KEEPALIVE_IDLE', 60))
+KEEPALIVE_INTERVAL = int(os.getenv('KEEPALIVE_INTERVAL', 10))
+KEEPALIVE_COUNT = int(os.getenv('KEEPALIVE_COUNT', 5))
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-lock = threading.Lock()
 to_monitor = []
+# Peer address -> monotonic time of the last frame received.
+last_seen = {}
+admission = Admission(limits)
+state_snapshot = Snapshot(SNAPSHOT_PATH, sessions.registry, mm.history_cache,
+                          mm.unread_counters, mm.lock)
+
+metrics.gauges['broadcast_queue_depth'] = broadcaster.queue_depth
+metrics.gauges['sessions'] = lambda: len(sessions.registry)
+metrics.gauges.update(mm.storage.gauges())
+metrics.gauges['sessions_reaped'] = lambda: sessions.registry.reaped
+metrics.gauges['throttled_requests'] = lambda: admission.throttled
+metrics.gauges['shed_requests'] = lambda: admission.shed
+metrics.gauges['over_limit_requests'] = lambda: admission.over_limit
+metrics.gauges['loop_lag_ms'] = lambda: round(admission.lag * 1000, 3)
+
+
+def enable_keepalive(writer):
+    # Lets the kernel detect half-open connections of silent peers.
+    sock = writer.get_extra_info('socket')
+    if sock is None:
+        return
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE,
+                        KEEPALIVE_IDLE)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                        KEEPALIVE_INTERVAL)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT,
+                        KEEPALIVE_COUNT)
+
+
+def watch_idle(addr: str, writer):
+    # The timer is not moved on every frame: when it fires the connection
+    # is either closed or the timer is rescheduled for the time remaining.
+    idle = time.monotonic() - last_seen.get(addr, 0)
+    if idle < IDLE_TIMEOUT:
+        wheel.schedule(('idle', addr), IDLE_TIMEOUT - idle,
+                       lambda: watch_idle(addr, writer))
+        return
+    logging.info(f'Closing connection {addr} idle for {idle:.0f}s.')
+    metrics.increment('idle_timeouts')
+    writer.close()
 
 
 def parsing_request(request):
@@ -28,117 +83,147 @@ def parsing_request(request):
         logging.error('No request for parsing.')
         return ''
     parsed_request = request.split()
-    logging.info('Request parsed.')
+    logging.debug('Request parsed.')
     return parsed_request
 
 
-async def method_allowed(parsed_request, writer):
+def method_allowed(parsed_request):
     if not parsed_request:
         response = 'First element has to be HTTP Method.'
         logging.error(response)
-        await send_message(str(response), writer)
-        return False
+        return False, response
     if parsed_request[0] not in ('GET', 'POST'):
         response = f'Method {parsed_request[0]} not allowed.'
         logging.error(response)
-        await send_message(str(response), writer)
-        return False
-    logging.info('Method allowed.')
-    return True
+        return False, response
+    logging.debug('Method allowed.')
+    return True, None
 
 
 async def send_message(message, writer):
     try:
-        message = message.encode()
-        logging.info('Message encoded.')
-        header = struct.pack('!I', len(message))
-        logging.info(f'Message byte len is {len(message)}')
-        writer.write(header)
-        logging.info('Header sent')
-        writer.write(message)
+        started = time.perf_counter()
+        frame = encode_frame(message)
+        logging.debug('Message byte len is %d', len(frame) - HEADER.size)
+        writer.write(frame)
         await writer.drain()
-        logging.info('Message sent to client.')
+        metrics.increment('bytes_out', len(frame))
+        metrics.send_latency.observe(time.perf_counter() - started)
+        logging.debug('Message sent to client.')
     except Exception as e:
         writer.write(f'Server-side error {e}'.encode())
         logging.error(f'{e}')
         await writer.drain()
 
 
-async def send_all(message):
+async def handle_request(request, addr):
+    logging.debug('Decoded request is %s', request)
     try:
-        for client in sessions.connected_clients:
-            await send_message(message, client)
+        parsed_request = parsing_request(request)
+    except Exception as e:
+        logging.error(f"Error parsing request: {e}")
+        return None
+
+    allowed, response = method_allowed(parsed_request)
+    if not allowed:
+        return response
+
+    route = parsed_request[1]
+    if route not in urls:
+        metrics.observe_request('invalid', 0.0, error=True)
+        return {'status': 'Invalid command.'}
+
+    session = sessions.registry.at(addr)
+    refusal = admission.admit(route, addr,
+                              session.user_id if session else None)
+    if refusal is not None:
+        logging.debug('Refused %s from %s: %s.', route, addr,
+                      refusal['status'])
+        return refusal
+
+    started = time.perf_counter()
+    try:
+        response = await urls[route](parsed_request, addr)
     except Exception as e:
         logging.error(f'{e}')
+        metrics.observe_request(route, time.perf_counter() - started,
+                                error=True)
+        return None
+    metrics.observe_request(route, time.perf_counter() - started)
+    return response
 
 
 async def run(reader, writer):
     async def close_session(writer, e, addr):
+        broadcaster.unsubscribe(str(addr))
         writer.close()
         await writer.wait_closed()
         logging.error(f'{e}')
-        user_id = sessions.sessions.pop([addr])['user_id']
-        sessions.sessions[user_id] = {'connected': False}
+        sessions.registry.disconnect(str(addr))
 
     addr = writer.get_extra_info('peername')
     logging.info(f'Accepted connection from {addr}')
-    sessions.connected_clients.append(writer)
-
-    while True:
-        try:
-            request = await reader.read(1024)
-
-            if len(request) == 0:
-                sessions.connected_clients.remove(writer)
-                writer.close()
-                await writer.wait_closed()
-                logging.info(f'Connection closed from addr {addr}.')
+    broadcaster.subscribe(writer, str(addr))
+    enable_keepalive(writer)
+    last_seen[str(addr)] = time.monotonic()
+    if IDLE_TIMEOUT:
+        watch_idle(str(addr), writer)
+    parser = RequestParser()
+    metrics.increment('connections')
+    metrics.active_connections += 1
+    try:
+        while True:
+            try:
+                request = await reader.read(READ_SIZE)
+
+                if len(request) == 0:
+                    broadcaster.unsubscribe(str(addr))
+                    writer.close()
+                    await writer.wait_closed()
+                    logging.info(f'Connection closed from addr {addr}.')
+                    sessions.registry.disconnect(str(addr))
+                    break
+
+                metrics.increment('bytes_in', len(request))
+                last_seen[str(addr)] = time.monotonic()
+                logging.debug('Client sent request.')
                 try:
-                    user_id = sessions.sessions.pop(str(addr))['user_id']
-                    sessions.sessions[user_id] = {'connected': False}
-                except Exception as e:
-                    logging.error(f'{e}')
-                    logging.info('Waiting for request.')
+                    requests = parser.feed(request)
+                except FrameError as e:
+                    await send_message(json.dumps({'status': f'{e}'}), writer)
+                    await close_session(writer, e, addr)
+                    break
+
+                # Pipelined requests are dispatched in order and their
+                # responses leave in a single write.
+                responses = []
+                for decoded_request in requests:
+                    response = await handle_request(decoded_request,
+                                                    str(addr))
+                    if response:
+                        responses.append(encode_frame(encode(
+                            response,
+                            sessions.registry.encoding_at(str(addr)))))
+                if responses:
+                    started = time.perf_counter()
+                    writer.writelines(responses)
+                    await writer.drain()
+                    metrics.send_latency.observe(
+                        time.perf_counter() - started)
+                    metrics.increment('bytes_out', sum(map(len, responses)))
+
+            except (asyncio.CancelledError, socket.error,
+                    ConnectionResetError) as e:
+                await close_session(writer, e, addr)
                 break
-
-            logging.info('Client sent request.')
-            decoded_request = request.decode()
-            logging.info(f'Decoded request is {decoded_request}')
-
-            try:
-                parsed_request = parsing_request(decoded_request)
             except Exception as e:
-                logging.error(f"Error parsing request: {e}")
-                logging.info('Waiting for request.')
-                continue
-
-            if not parsed_request or not await method_allowed(parsed_request,
-                                                              writer):
-                logging.info('Waiting for request.')
-                continue
-
-            if not parsed_request[1] in urls:
-                bad_response = json.dumps({'status': 'Invalid command.'})
-                await send_message(bad_response, writer)
-                logging.info('Waiting for request.')
-                continue
-
-            response = await urls[parsed_request[1]](parsed_request, str(addr))
-            if response:
-                await send_message(response, writer)
-
-            if sessions.messages_to_send:
-                # time.sleep(6)
-                with lock:
-                    await send_all(str(sessions.messages_to_send.pop(0)))
-
-        except (asyncio.CancelledError, SocketError,
-                ConnectionResetError) as e:
-            await close_session(writer, e, addr)
-            break
-        except Exception as e:
-            logging.error(f'{e}')
-            logging.info('Waiting for request.')
+                logging.error(f'{e}')
+                logging.debug('Waiting for request.')
+    finally:
+        metrics.active_connections -= 1
+        wheel.cancel(('idle', str(addr)))
+        last_seen.pop(str(addr), None)
+        admission.forget(str(addr))
 
 
 if __name__ == '__main__':
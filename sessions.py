@@ -1,6 +1,155 @@
-from multiprocessing import Manager
+import asyncio
+import json
+import logging
+import os
+import time
 
-manager = Manager()
-connected_clients = []
-messages_to_send = manager.list()
-sessions = manager.dict()
\ No newline at end of file
+from dotenv import load_dotenv
+
+from timer_wheel import wheel
+
+load_dotenv()
+
+SESSIONS_EXPORT_PATH = os.getenv('SESSIONS_EXPORT_PATH', '')
+SESSIONS_EXPORT_INTERVAL = float(os.getenv('SESSIONS_EXPORT_INTERVAL', 3))
+# Disconnected sessions are forgotten this many seconds later.
+SESSION_RETENTION = float(os.getenv('SESSION_RETENTION', 300))
+
+
+class Session:
+    __slots__ = ('user_id', 'addr', 'connected', 'connected_at', 'encoding')
+
+    def __init__(self, user_id: str, addr: str, encoding: str = 'json'):
+        self.user_id = user_id
+        self.addr = addr
+        self.encoding = encoding
+        self.connected = True
+        self.connected_at = time.time()
+
+    def as_dict(self) -> dict:
+        return {'user_id': self.user_id,
+                'addr': self.addr,
+                'connected': self.connected,
+                'connected_at': self.connected_at,
+                'encoding': self.encoding}
+
+
+class SessionRegistry:
+    """Sessions of this process, indexed by peer address and by user_id.
+
+    In multi-worker mode ``remote`` mirrors the users connected to the other
+    workers and ``observers`` are told about every local change.
+    Disconnected sessions are reaped ``retention`` seconds later.
+    """
+
+    def __init__(self, retention=SESSION_RETENTION, timers=wheel):
+        self.by_addr = {}
+        self.by_user = {}
+        self.remote = {}
+        self.observers = []
+        self.retention = retention
+        self.timers = timers
+        self.reaped = 0
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.by_user or key in self.by_addr or \
+            key in self.remote
+
+    def _notify(self, session: Session):
+        for observer in self.observers:
+            observer(session)
+
+    def __len__(self) -> int:
+        return len(self.by_user)
+
+    def connect(self, addr: str, user_id: str,
+                encoding: str = 'json') -> Session:
+        self.disconnect(addr)
+        previous = self.by_user.get(user_id)
+        if previous is not None and previous.addr is not None:
+            # A resumed session leaves its old connection behind.
+            self.by_addr.pop(previous.addr, None)
+        session = Session(user_id, addr, encoding)
+        self.by_user[user_id] = session
+        self.by_addr[addr] = session
+        self.timers.cancel(('reap', user_id))
+        self._notify(session)
+        return session
+
+    def disconnect(self, addr: str):
+        session = self.by_addr.pop(addr, None)
+        if session is not None:
+            session.connected = False
+            session.addr = None
+            self.timers.schedule(('reap', session.user_id), self.retention,
+                                 lambda: self.reap(session.user_id))
+            self._notify(session)
+        return session
+
+    def restore(self, user_id: str, encoding: str, connected_at: float):
+        """Add a disconnected session saved before a restart."""
+        if user_id in self.by_user:
+            return
+        session = Session(user_id, None, encoding)
+        session.connected = False
+        session.connected_at = connected_at
+        self.by_user[user_id] = session
+        self.timers.schedule(('reap', user_id), self.retention,
+                             lambda: self.reap(user_id))
+
+    def reap(self, user_id: str):
+        session = self.by_user.get(user_id)
+        if session is not None and not session.connected:
+            del self.by_user[user_id]
+            self.reaped += 1
+
+    def get(self, user_id: str):
+        return self.by_user.get(user_id)
+
+    def at(self, addr: str):
+        return self.by_addr.get(addr)
+
+    def encoding_at(self, addr: str) -> str:
+        session = self.by_addr.get(addr)
+        return session.encoding if session is not None else 'json'
+
+    def is_connected(self, user_id: str) -> bool:
+        session = self.by_user.get(user_id)
+        if session is not None:
+            return session.connected
+        return self.remote.get(user_id, False)
+
+    def update_remote(self, user_id: str, connected: bool):
+        if connected:
+            self.remote[user_id] = True
+        else:
+            self.remote.pop(user_id, None)
+
+    def export(self) -> dict:
+        # Aggregates only, so exporting stays cheap with many sessions.
+        return {'exported_at': time.time(),
+                'connected': len(self.by_addr),
+                'disconnected': len(self.by_user) - len(self.by_addr),
+                'remote': len(self.remote),
+                'reaped': self.reaped,
+                'timers': len(self.timers)}
+
+
+def export_state(path: str = SESSIONS_EXPORT_PATH):
+    temporary_path = f'{path}.tmp'
+    with open(temporary_path, mode='w') as file:
+        json.dump(registry.export(), file)
+    os.replace(temporary_path, path)
+
+
+async def export_sessions(path: str = SESSIONS_EXPORT_PATH,
+                          interval: float = SESSIONS_EXPORT_INTERVAL):
+    while True:
+        try:
+            export_state(path)
+        except OSError as e:
+            logging.error(f'Error exporting sessions: {e}')
+        await asyncio.sleep(interval)
+
+
+registry = SessionRegistry()
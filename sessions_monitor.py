@@ -1,3 +1,4 @@
+import json
 import time
 
 from multiprocessing import Process
@@ -7,10 +8,15 @@ import sessions
 
 def session_monitor():
     while True:
-        s = sessions.sessions
-        m = sessions.messages_to_send
-        print(f'{s}\n{m}')
-        time.sleep(3)
+        try:
+            with open(sessions.SESSIONS_EXPORT_PATH, mode='r') as file:
+                s = json.load(file)
+            print(f'connected={s["connected"]} '
+                  f'disconnected={s["disconnected"]} remote={s["remote"]} '
+                  f'reaped={s["reaped"]} timers={s["timers"]}')
+        except (OSError, ValueError, KeyError) as e:
+            print(f'No session export available: {e}')
+        time.sleep(sessions.SESSIONS_EXPORT_INTERVAL)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,266 @@
+import asyncio
+import logging
+import os
+import struct
+import threading
+import time
+
+from dotenv import load_dotenv
+
+from codec import (decode_binary, encode_binary, read_str, read_varint,
+                   write_bytes, write_varint)
+
+load_dotenv()
+
+SNAPSHOT_PATH = os.getenv('SNAPSHOT_PATH') or os.path.join(
+    os.getenv('CHAT_LOG_DIR', ''), 'server.snapshot')
+# Seconds between snapshots; 0 turns snapshots and their journal off.
+SNAPSHOT_INTERVAL = float(os.getenv('SNAPSHOT_INTERVAL', 60))
+
+HEADER = struct.Struct('!4sBd')
+MAGIC = b'MSNP'
+VERSION = 1
+CONNECTED_AT = struct.Struct('!d')
+# Journal records: a session connected, a user's read count in a chat.
+SESSION_RECORD = ord('S')
+ACK_RECORD = ord('A')
+
+
+def _write_str(out: bytearray, value: str):
+    write_bytes(out, value.encode())
+
+
+def _read_bytes(data, position: int):
+    length, position = read_varint(data, position)
+    return data[position:position + length], position + length
+
+
+class Snapshot:
+    """Sessions, unread counters and hot history caches saved across
+    restarts.
+
+    Every ``interval`` seconds the whole state is written to a binary
+    snapshot; changes in between are appended to a journal next to it. The
+    journal is rotated to ``.old`` before a snapshot is collected and
+    dropped once the snapshot replaced the previous one, so a crash at any
+    point leaves a snapshot plus the journals written after it. Replaying a
+    record twice is harmless: sessions are keyed by user_id and read counts
+    only grow.
+    """
+
+    def __init__(self, path, registry, history_cache, unread_counters, lock,
+                 interval=SNAPSHOT_INTERVAL):
+        self.path = path
+        self.journal_path = f'{path}.journal'
+        self.registry = registry
+        self.history_cache = history_cache
+        self.unread_counters = unread_counters
+        # Held while the caches and counters are read or changed.
+        self.lock = lock
+        self.interval = interval
+        self.journal = None
+        # Journal writes come from the event loop and the storage threads.
+        self.journal_lock = threading.Lock()
+
+    def _append(self, record: bytearray):
+        out = bytearray()
+        write_bytes(out, bytes(record))
+        with self.journal_lock:
+            if self.journal is not None:
+                self.journal.write(out)
+                self.journal.flush()
+
+    def log_session(self, session):
+        if not session.connected:
+            return
+        record = bytearray((SESSION_RECORD,))
+        _write_str(record, session.user_id)
+        _write_str(record, session.encoding)
+        record += CONNECTED_AT.pack(session.connected_at)
+        self._append(record)
+
+    def log_ack(self, chat_id: str, user_id: str, count: int):
+        record = bytearray((ACK_RECORD,))
+        _write_str(record, chat_id)
+        _write_str(record, user_id)
+        write_varint(record, count)
+        self._append(record)
+
+    def _restore_session(self, data, position):
+        user_id, position = read_str(data, position)
+        encoding, position = read_str(data, position)
+        connected_at, = CONNECTED_AT.unpack_from(data, position)
+        self.registry.restore(user_id, encoding, connected_at)
+        return position + CONNECTED_AT.size
+
+    def _restore_read_count(self, data, position):
+        chat_id, position = read_str(data, position)
+        user_id, position = read_str(data, position)
+        count, position = read_varint(data, position)
+        counters = self.unread_counters
+        counters.read_counts[chat_id, user_id] = max(
+            counters.read_counts.get((chat_id, user_id), 0), count)
+        chats = counters.user_chats.get(user_id)
+        if chats is not None:
+            chats.add(chat_id)
+        return position
+
+    def _load_snapshot(self) -> bool:
+        try:
+            with open(self.path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return False
+        magic, version, written_at = HEADER.unpack_from(data)
+        if magic != MAGIC or version != VERSION:
+            logging.error(f'Ignoring snapshot {self.path} of an unknown '
+                          'format.')
+            return False
+        position = HEADER.size
+        count, position = read_varint(data, position)
+        for _ in range(count):
+            position = self._restore_session(data, position)
+        count, position = read_varint(data, position)
+        for _ in range(count):
+            user_id, position = read_str(data, position)
+            chats, position = read_varint(data, position)
+            user_chats = self.unread_counters.user_chats[user_id] = set()
+            for _ in range(chats):
+                chat_id, position = read_str(data, position)
+                user_chats.add(chat_id)
+        count, position = read_varint(data, position)
+        for _ in range(count):
+            position = self._restore_read_count(data, position)
+        count, position = read_varint(data, position)
+        for _ in range(count):
+            chat_id, position = read_str(data, position)
+            blob, position = _read_bytes(data, position)
+            history = decode_binary(blob)
+            self.history_cache.warm(chat_id, history['messages'],
+                                    history['count'])
+        logging.info(f'Restored the snapshot of '
+                     f'{time.time() - written_at:.0f}s ago from {self.path}.')
+        return True
+
+    def _replay(self, path) -> int:
+        try:
+            with open(path, 'rb') as file:
+                data = file.read()
+        except FileNotFoundError:
+            return 0
+        replayed = 0
+        position = 0
+        while position < len(data):
+            try:
+                record, position = _read_bytes(data, position)
+                if position > len(data):
+                    raise IndexError(position)
+                if record[0] == SESSION_RECORD:
+                    self._restore_session(record, 1)
+                elif record[0] == ACK_RECORD:
+                    self._restore_read_count(record, 1)
+            except (IndexError, struct.error, UnicodeDecodeError):
+                logging.error(f'Skipping the torn tail of {path}.')
+                break
+            replayed += 1
+        return replayed
+
+    def restore(self):
+        """Load the snapshot and replay the journals written after it, then
+        start journaling."""
+        with self.lock:
+            try:
+                self._load_snapshot()
+            except (IndexError, KeyError, struct.error, ValueError) as e:
+                logging.error(f'Error restoring {self.path}: {e}')
+            replayed = self._replay(f'{self.journal_path}.old') + \
+                self._replay(self.journal_path)
+        if replayed:
+            logging.info(f'Replayed {replayed} journal records.')
+        self.journal = open(self.journal_path, 'ab')
+        self.registry.observers.append(self.log_session)
+        self.unread_counters.observers.append(self.log_ack)
+
+    def collect_sessions(self) -> list:
+        """Rotate the journal and return the sessions to save.
+
+        Runs on the event loop, which owns the registry.
+        """
+        old_path = f'{self.journal_path}.old'
+        with self.journal_lock:
+            if self.journal is not None:
+                self.journal.close()
+                if os.path.exists(old_path):
+                    # The last snapshot failed: keep every record since the
+                    # one before it.
+                    with open(self.journal_path, 'rb') as journal, \
+                            open(old_path, 'ab') as old:
+                        old.write(journal.read())
+                    os.unlink(self.journal_path)
+                else:
+                    os.replace(self.journal_path, old_path)
+                self.journal = open(self.journal_path, 'ab')
+        return [(session.user_id, session.encoding, session.connected_at)
+                for session in self.registry.by_user.values()]
+
+    def write(self, sessions: list):
+        out = bytearray(HEADER.pack(MAGIC, VERSION, time.time()))
+        write_varint(out, len(sessions))
+        for user_id, encoding, connected_at in sessions:
+            _write_str(out, user_id)
+            _write_str(out, encoding)
+            out += CONNECTED_AT.pack(connected_at)
+        with self.lock:
+            counters = self.unread_counters
+            write_varint(out, len(counters.user_chats))
+            for user_id, chats in counters.user_chats.items():
+                _write_str(out, user_id)
+                write_varint(out, len(chats))
+                for chat_id in chats:
+                    _write_str(out, chat_id)
+            write_varint(out, len(counters.read_counts))
+            for (chat_id, user_id), count in counters.read_counts.items():
+                _write_str(out, chat_id)
+                _write_str(out, user_id)
+                write_varint(out, count)
+            # Least recently used first, so that restoring keeps the order.
+            chats = list(self.history_cache.chats.items())
+            write_varint(out, len(chats))
+            for chat_id, history in chats:
+                _write_str(out, chat_id)
+                write_bytes(out, encode_binary(
+                    {'count': history.count,
+                     'messages': history.latest(len(history.messages))}))
+        temporary_path = f'{self.path}.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(out)
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.path)
+        try:
+            os.unlink(f'{self.journal_path}.old')
+        except FileNotFoundError:
+            pass
+        logging.debug('Wrote a snapshot of %d bytes to %s.', len(out),
+                      self.path)
+
+    async def write_periodically(self, executor=None):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await loop.run_in_executor(executor, self.write,
+                                           self.collect_sessions())
+            except OSError as e:
+                logging.error(f'Error writing snapshot: {e}')
+
+    def close(self):
+        if self.journal is None:
+            return
+        try:
+            self.write(self.collect_sessions())
+        except OSError as e:
+            logging.error(f'Error writing snapshot: {e}')
+        with self.journal_lock:
+            self.journal.close()
+            self.journal = None
@@ -0,0 +1,191 @@
+import os
+import sqlite3
+
+from datetime import datetime
+from dotenv import load_dotenv
+
+from codec import timestamp_to_us
+from message_log import FIELDS
+from message_writer import DURABILITY
+from read_state import READ_ACK_FLUSH_INTERVAL, ReadState
+from storage import Storage
+
+load_dotenv()
+
+SQLITE_PATH = os.getenv('SQLITE_PATH', '')
+SQLITE_BUSY_TIMEOUT = float(os.getenv('SQLITE_BUSY_TIMEOUT', 5.0))
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS messages (
+    chat_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts INTEGER NOT NULL,
+    timestamp TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    message TEXT NOT NULL,
+    PRIMARY KEY (chat_id, seq)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS messages_chat_ts ON messages (chat_id, ts);
+CREATE TABLE IF NOT EXISTS read_states (
+    user_id TEXT NOT NULL,
+    chat_id TEXT NOT NULL,
+    watermark INTEGER NOT NULL,
+    sparse TEXT NOT NULL,
+    PRIMARY KEY (user_id, chat_id)
+) WITHOUT ROWID;
+'''
+
+# Constant statements, so that sqlite3 reuses the prepared statement from
+# its per-connection cache.
+NEXT_SEQ = 'SELECT coalesce(max(seq) + 1, 0) FROM messages WHERE chat_id = ?'
+INSERT_MESSAGE = ('INSERT INTO messages (chat_id, seq, ts, timestamp, '
+                  'user_id, message) VALUES (?, ?, ?, ?, ?, ?)')
+SELECT_RANGE = ('SELECT timestamp, user_id, message, seq FROM messages '
+                'WHERE chat_id = ? AND seq >= ? AND seq < ? ORDER BY seq')
+SEEK_TS = ('SELECT seq FROM messages WHERE chat_id = ? AND ts >= ? '
+           'ORDER BY ts, seq LIMIT 1')
+FIND_TS = ('SELECT seq FROM messages WHERE chat_id = ? AND ts = ? '
+           'ORDER BY seq LIMIT 1')
+SELECT_READ_STATE = ('SELECT watermark, sparse FROM read_states '
+                     'WHERE user_id = ? AND chat_id = ?')
+SELECT_USER_CHATS = 'SELECT chat_id FROM read_states WHERE user_id = ?'
+UPSERT_READ_STATE = ('INSERT OR REPLACE INTO read_states (user_id, chat_id, '
+                     'watermark, sparse) VALUES (?, ?, ?, ?)')
+
+
+class SqliteStorage(Storage):
+    """Messages and read states in one SQLite database in WAL mode.
+
+    Read states acked since the last ``flush_reads`` are kept in memory and
+    merged with what other processes stored when they are written.
+    """
+
+    def __init__(self, path=None, durability=DURABILITY,
+                 write_through=not READ_ACK_FLUSH_INTERVAL):
+        self.path = path or SQLITE_PATH or os.path.join(
+            os.getenv('CHAT_LOG_DIR'), 'messages.db')
+        self.connection = sqlite3.connect(
+            self.path, timeout=SQLITE_BUSY_TIMEOUT, isolation_level=None,
+            check_same_thread=False)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        # WAL commits at NORMAL are only synced at checkpoints; FULL syncs
+        # every commit, which is what the fsyncing durability modes ask for.
+        self.connection.execute('PRAGMA synchronous=%s' % (
+            'NORMAL' if durability == 'none' else 'FULL'))
+        self.connection.executescript(SCHEMA)
+        self.write_through = write_through
+        # (chat_id, user_id) -> ReadState changed since the last flush.
+        self.pending = {}
+
+    def append(self, chat_id, rows):
+        cursor = self.connection.cursor()
+        # IMMEDIATE takes the write lock up front, so the seq and the
+        # timestamps stay ordered with other processes appending.
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            first_seq = cursor.execute(NEXT_SEQ, (chat_id,)).fetchone()[0]
+            for row in rows:
+                if row[0] is None:
+                    row[0] = datetime.now().isoformat()
+            cursor.executemany(INSERT_MESSAGE, [
+                (chat_id, seq, timestamp_to_us(row[0]), *row)
+                for seq, row in enumerate(rows, first_seq)])
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        return first_seq
+
+    def sync(self, chat_ids):
+        # Commits are synced by synchronous=FULL.
+        pass
+
+    def count(self, chat_id):
+        return self.connection.execute(NEXT_SEQ, (chat_id,)).fetchone()[0]
+
+    def read(self, chat_id, start, stop=None):
+        stop = self.count(chat_id) if stop is None else stop
+        return [dict(zip(FIELDS + ('seq',), row))
+                for row in self.connection.execute(
+                    SELECT_RANGE, (chat_id, max(start, 0), stop))]
+
+    def seek_timestamp(self, chat_id, timestamp):
+        row = self.connection.execute(
+            SEEK_TS, (chat_id, timestamp_to_us(timestamp))).fetchone()
+        return row[0] if row is not None else self.count(chat_id)
+
+    def find_timestamp(self, chat_id, timestamp):
+        row = self.connection.execute(
+            FIND_TS, (chat_id, timestamp_to_us(timestamp))).fetchone()
+        return row[0] if row is not None else None
+
+    def _load_read_state(self, chat_id, user_id):
+        row = self.connection.execute(
+            SELECT_READ_STATE, (user_id, chat_id)).fetchone()
+        if row is None:
+            return None
+        watermark, sparse = row
+        return ReadState(watermark,
+                         {int(seq) for seq in sparse.split('/') if seq})
+
+    def read_state(self, chat_id, user_id):
+        state = self.pending.get((chat_id, user_id))
+        if state is None:
+            state = self._load_read_state(chat_id, user_id)
+        return state
+
+    def user_chats(self, user_id):
+        chats = {row[0] for row in self.connection.execute(
+            SELECT_USER_CHATS, (user_id,))}
+        chats.update(chat_id for chat_id, pending_user in self.pending
+                     if pending_user == user_id)
+        return chats
+
+    def _pending_state(self, chat_id, user_id) -> ReadState:
+        state = self.pending.get((chat_id, user_id))
+        if state is None:
+            state = self._load_read_state(chat_id, user_id) or ReadState()
+        return state
+
+    def ack(self, chat_id, user_id, seqs):
+        state = self._pending_state(chat_id, user_id)
+        acked = sum(state.ack(seq) for seq in seqs)
+        if acked:
+            self.pending[chat_id, user_id] = state
+            if self.write_through:
+                self.flush_reads()
+        return acked
+
+    def ack_upto(self, chat_id, user_id, watermark):
+        state = self._pending_state(chat_id, user_id)
+        advanced = state.advance(watermark)
+        if advanced:
+            self.pending[chat_id, user_id] = state
+            if self.write_through:
+                self.flush_reads()
+        return advanced
+
+    def flush_reads(self):
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, {}
+        cursor = self.connection.cursor()
+        cursor.execute('BEGIN IMMEDIATE')
+        try:
+            rows = []
+            for (chat_id, user_id), state in pending.items():
+                stored = self._load_read_state(chat_id, user_id)
+                if stored is not None:
+                    state.merge(stored)
+                rows.append((user_id, chat_id, state.watermark,
+                             '/'.join(map(str, sorted(state.sparse)))))
+            cursor.executemany(UPSERT_READ_STATE, rows)
+            cursor.execute('COMMIT')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            self.pending = {**pending, **self.pending}
+            raise
+
+    def close(self):
+        self.flush_reads()
+        self.connection.close()
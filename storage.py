@@ -0,0 +1,82 @@
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'csv')
+
+
+class Storage:
+    """Persistence of chat messages and read states.
+
+    Messages of a chat are numbered by a dense seq starting at 0. Rows are
+    ``[timestamp, user_id, message]`` lists; a ``None`` timestamp is stamped
+    by the backend while appending, so timestamps grow with seq. Messages
+    are read back as dicts of the three fields and their ``seq``. Backends
+    are not thread-safe: messages_manager serializes every call.
+    """
+
+    def append(self, chat_id: str, rows) -> int:
+        """Append rows in one batch and return the seq of the first."""
+        raise NotImplementedError
+
+    def sync(self, chat_ids):
+        """Make the rows appended to the chats durable."""
+        raise NotImplementedError
+
+    def count(self, chat_id: str) -> int:
+        raise NotImplementedError
+
+    def exists(self, chat_id: str) -> bool:
+        """Whether anything was stored in the chat; creates nothing."""
+        return self.count(chat_id) > 0
+
+    def read(self, chat_id: str, start: int, stop: int = None) -> list:
+        """Return the messages with start <= seq < stop as dicts."""
+        raise NotImplementedError
+
+    def tail(self, chat_id: str, limit: int) -> list:
+        return self.read(chat_id, self.count(chat_id) - limit)
+
+    def seek_timestamp(self, chat_id: str, timestamp: str) -> int:
+        """Return the seq of the first message at or after ``timestamp``."""
+        raise NotImplementedError
+
+    def find_timestamp(self, chat_id: str, timestamp: str):
+        """Return the seq of the message stamped ``timestamp`` or None."""
+        raise NotImplementedError
+
+    def read_state(self, chat_id: str, user_id: str):
+        """Return the ReadState of the user in the chat or None."""
+        raise NotImplementedError
+
+    def user_chats(self, user_id: str) -> set:
+        """Return the chats the user has a read state in."""
+        raise NotImplementedError
+
+    def ack(self, chat_id: str, user_id: str, seqs) -> int:
+        raise NotImplementedError
+
+    def ack_upto(self, chat_id: str, user_id: str, watermark: int) -> bool:
+        raise NotImplementedError
+
+    def flush_reads(self):
+        """Persist the acks merged in memory since the last call."""
+        raise NotImplementedError
+
+    def gauges(self) -> dict:
+        return {}
+
+    def close(self):
+        pass
+
+
+def open_storage(backend: str = STORAGE_BACKEND, **kwargs) -> Storage:
+    if backend == 'csv':
+        from csv_storage import CsvStorage
+        return CsvStorage(**kwargs)
+    if backend == 'sqlite':
+        from sqlite_storage import SqliteStorage
+        return SqliteStorage(**kwargs)
+    raise ValueError(f'Unknown storage backend {backend!r}.')
@@ -0,0 +1,74 @@
+import asyncio
+import logging
+import math
+import os
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+TIMER_TICK = float(os.getenv('TIMER_TICK', 1.0))
+TIMER_SLOTS = int(os.getenv('TIMER_SLOTS', 512))
+
+
+class TimerWheel:
+    """Hashed timing wheel with a resolution of ``tick`` seconds.
+
+    A timer lands in the slot of the tick it expires on, so scheduling and
+    cancelling are O(1) dict operations; each tick only visits its own
+    slot, where timers more than one revolution away are skipped.
+    Scheduling a key again replaces its pending timer.
+    """
+
+    def __init__(self, tick=TIMER_TICK, slots=TIMER_SLOTS):
+        self.tick = tick
+        self.slots = [{} for _ in range(slots)]
+        # key -> slot index of its pending timer.
+        self.timers = {}
+        self.started = time.monotonic()
+        self.current = 0
+
+    def __len__(self) -> int:
+        return len(self.timers)
+
+    def schedule(self, key, delay: float, callback):
+        self.cancel(key)
+        expires = self.current + max(math.ceil(delay / self.tick), 1)
+        slot = expires % len(self.slots)
+        self.slots[slot][key] = (expires, callback)
+        self.timers[key] = slot
+
+    def cancel(self, key) -> bool:
+        slot = self.timers.pop(key, None)
+        if slot is None:
+            return False
+        del self.slots[slot][key]
+        return True
+
+    def advance(self, now: float = None) -> int:
+        now = time.monotonic() if now is None else now
+        target = int((now - self.started) / self.tick)
+        fired = 0
+        while self.current < target:
+            self.current += 1
+            slot = self.slots[self.current % len(self.slots)]
+            expired = [key for key, (expires, _) in slot.items()
+                       if expires <= self.current]
+            for key in expired:
+                _, callback = slot.pop(key)
+                del self.timers[key]
+                try:
+                    callback()
+                except Exception as e:
+                    logging.error(f'Error in timer {key!r}: {e}')
+                fired += 1
+        return fired
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.tick)
+            self.advance()
+
+
+wheel = TimerWheel()
@@ -0,0 +1,64 @@
+class UnreadCounters:
+    """Unread message counts of users per chat.
+
+    A count is the number of messages in the chat minus the number the user
+    read there. Both are updated as messages are appended and acked, and
+    loaded from storage the first time a chat or user is asked for, as are
+    the chats a user has read in. With ``shared`` storage other processes
+    append and ack too, so chat totals and read counts are always taken from
+    storage.
+    """
+
+    def __init__(self, storage, shared=False):
+        self.storage = storage
+        self.shared = shared
+        # chat_id -> messages in the chat.
+        self.totals = {}
+        # (chat_id, user_id) -> messages the user read in the chat.
+        self.read_counts = {}
+        # user_id -> chats the user has a read state in.
+        self.user_chats = {}
+        # Called with (chat_id, user_id, read count) on every ack.
+        self.observers = []
+
+    def appended(self, chat_id: str, total: int):
+        if chat_id in self.totals:
+            self.totals[chat_id] = max(self.totals[chat_id], total)
+
+    def acked(self, chat_id: str, user_id: str, state):
+        count = self.read_counts[chat_id, user_id] = state.count() \
+            if state is not None else 0
+        chats = self.user_chats.get(user_id)
+        if chats is not None:
+            chats.add(chat_id)
+        for observer in self.observers:
+            observer(chat_id, user_id, count)
+
+    def total(self, chat_id: str) -> int:
+        if self.shared:
+            return self.storage.count(chat_id)
+        total = self.totals.get(chat_id)
+        if total is None:
+            total = self.totals[chat_id] = self.storage.count(chat_id)
+        return total
+
+    def read_count(self, chat_id: str, user_id: str) -> int:
+        count = self.read_counts.get((chat_id, user_id))
+        if count is None or self.shared:
+            state = self.storage.read_state(chat_id, user_id)
+            count = self.read_counts[chat_id, user_id] = \
+                state.count() if state is not None else 0
+        return count
+
+    def counts(self, user_id: str, chat_ids=()) -> dict:
+        """Return chat_id -> unread count for the chats the user read in
+        and those of ``chat_ids`` with messages stored."""
+        chats = self.user_chats.get(user_id)
+        if chats is None:
+            chats = self.user_chats[user_id] = \
+                set(self.storage.user_chats(user_id))
+        chats = chats.union(chat_id for chat_id in chat_ids
+                            if self.storage.exists(chat_id))
+        return {chat_id: max(self.total(chat_id)
+                             - self.read_count(chat_id, user_id), 0)
+                for chat_id in sorted(chats)}
@@ -1,17 +1,17 @@
-import json
 import logging
-import threading
 import uuid
 
 import messages_manager as mm
 
 import sessions
+from admission import Limit
+from broadcast import broadcaster
+from codec import ENCODINGS
+from metrics import metrics
 
 logging.basicConfig(level=logging.INFO,
                     format='%(asctime)s - %(levelname)s - %(message)s')
 
-lock = threading.Lock()
-
 
 class PostConnection:
     allowed_methods = ['POST']
@@ -20,18 +20,37 @@ class PostConnection:
     async def view(cls, parsed_request, addr, *args, **kwargs):
         if parsed_request[0] not in PostConnection.allowed_methods:
             return 'Wrong method.'
+        # POST /connect [encoding] [user_id]; a user_id resumes the session
+        # of an earlier connection, also one saved before a restart.
+        arguments = parsed_request[2:]
+        encoding = arguments.pop(0) if arguments and \
+            (arguments[0] in ENCODINGS or len(arguments) > 1) else 'json'
+        if encoding not in ENCODINGS:
+            return {'status': f'Unknown encoding {encoding}.'}
         user_id = str(uuid.uuid4())
-        sessions.sessions[user_id] = {'connected': True}
-        sessions.sessions[addr] = {'user_id': user_id}
-        logging.info(f'User {user_id} connected on {addr}.')
-        latest_messages = mm.get_latest_messages('public')
-        logging.info('Latest messages loaded.')
+        if arguments:
+            try:
+                user_id = str(uuid.UUID(arguments[0]))
+            except ValueError:
+                return {'status': f'Invalid user_id {arguments[0]}.'}
+        resumed = user_id in sessions.registry
+        sessions.registry.connect(addr, user_id, encoding)
+        broadcaster.set_encoding(addr, encoding)
+        logging.info(f'User {user_id} {"resumed" if resumed else "connected"} '
+                     f'on {addr}.')
+        if not resumed:
+            # A new user starts reading at the newest message.
+            await mm.call(mm.start_at_tail, user_id)
+        latest_messages = await mm.call(mm.get_latest_messages, 'public')
+        logging.debug('Latest messages loaded.')
         response = {
             'status': 'connected',
             'user_id': user_id,
             'messages': latest_messages
         }
-        return str(json.dumps(response))
+        if resumed:
+            response['resumed'] = True
+        return response
 
 
 class GetStatus:
@@ -42,8 +61,7 @@ class GetStatus:
         if parsed_request[0] not in GetStatus.allowed_methods:
             return 'Wrong method.'
         user_id = parsed_request[2]
-        if user_id in sessions.sessions and \
-                sessions.sessions[user_id]['connected']:
+        if sessions.registry.is_connected(user_id):
             response = {'status': 'connected',
                         'user_id': user_id,
                         }
@@ -51,7 +69,7 @@ class GetStatus:
             response = {'status': 'not connected',
                         'user_id': user_id,
                         }
-        return str(json.dumps(response))
+        return response
 
 
 class PostSend:
@@ -63,29 +81,27 @@ class PostSend:
             return 'Wrong method.'
         chat_id, user_id, message = \
             parsed_request[2], parsed_request[3], ' '.join(parsed_request[4:]),
-        if (user_id in sessions.sessions) and \
-           (sessions.sessions[user_id]['connected']) and \
-           (chat_id == 'public' or chat_id in sessions.sessions):
-            message_data = mm.save_message_to_csv(message, user_id, chat_id)
+        if sessions.registry.is_connected(user_id) and \
+           (chat_id == 'public' or chat_id in sessions.registry):
+            message_data = await mm.save_message(message, user_id, chat_id)
             message_to_send = dict()
             message_to_send['timestamp'] = message_data[0]
             message_to_send['user_id'] = message_data[1]
             message_to_send['message'] = message_data[2]
+            message_to_send['seq'] = message_data[3]
 
             response = {'status': 'message sent',
                         'user_id': user_id,
+                        'seq': message_data[3],
                         }
             if chat_id == 'public':
-                with lock:
-                    sessions.messages_to_send.append(
-                        json.dumps({'messages': [message_to_send]}))
-                logging.info(f'Message \'{message}\' '
-                             'appended to messages_to_send list.')
+                broadcaster.publish({'messages': [message_to_send]})
+                logging.debug('Message %r broadcast.', message)
         else:
             response = {'status': 'user not connected',
                         'user_id': user_id,
                         }
-        return str(json.dumps(response))
+        return response
 
 
 class PostMarkRead:
@@ -95,10 +111,14 @@ class PostMarkRead:
     async def view(cls, parsed_request, *args, **kwargs):
         if parsed_request[0] not in PostMarkRead.allowed_methods:
             return 'Wrong method.'
-        timestamps = parsed_request[2]
+        # Seqs or timestamps of the messages, joined with '/'.
+        keys = parsed_request[2]
         user_id = parsed_request[3]
         chat_id = parsed_request[4]
-        mm.update_message_status(timestamps, user_id, chat_id)
+        # 'upto' acks every message up to the key cumulatively.
+        upto = len(parsed_request) > 5 and parsed_request[5] == 'upto'
+        await mm.call(mm.update_message_status, keys, user_id,
+                      chat_id, upto)
         return None
 
 
@@ -111,10 +131,21 @@ class GetUnread:
             return 'Wrong method.'
         chat_id = parsed_request[2]
         user_id = parsed_request[3]
-        if (user_id in sessions.sessions) and \
-           (sessions.sessions[user_id]['connected']) and \
-           (chat_id == 'public' or chat_id in sessions.sessions):
-            unread_messages = mm.get_unread_messages(user_id, chat_id)
+        if sessions.registry.is_connected(user_id) and \
+           (chat_id == 'public' or chat_id in sessions.registry):
+            try:
+                limit = min(max(int(parsed_request[4]), 1),
+                            mm.UNREAD_LIMIT) \
+                    if len(parsed_request) > 4 else mm.UNREAD_LIMIT
+                cursor = parsed_request[5] if len(parsed_request) > 5 \
+                    else None
+                unread_messages, cursor = await mm.call(
+                    mm.get_unread_page, user_id, chat_id, limit, cursor)
+            except ValueError as e:
+                response = {'status': f'{e}',
+                            'user_id': user_id,
+                            }
+                return response
             if not unread_messages:
                 response = {
                     'status': 'no unread messages',
@@ -127,11 +158,120 @@ class GetUnread:
                     'user_id': user_id,
                     'messages': unread_messages
                 }
+            if cursor:
+                response['cursor'] = cursor
         else:
             response = {'status': 'user not connected',
                         'user_id': user_id,
                         }
-        return str(json.dumps(response))
+        return response
+
+
+class GetUnreadCounts:
+    allowed_methods = ['GET']
+
+    @classmethod
+    async def view(cls, parsed_request, *args, **kwargs):
+        if parsed_request[0] not in GetUnreadCounts.allowed_methods:
+            return 'Wrong method.'
+        user_id = parsed_request[2]
+        if not sessions.registry.is_connected(user_id):
+            return {'status': 'user not connected',
+                    'user_id': user_id,
+                    }
+        counts = await mm.call(mm.get_unread_counts, user_id)
+        return {'status': 'unread counts',
+                'user_id': user_id,
+                'counts': counts
+                }
+
+
+class GetHistory:
+    allowed_methods = ['GET']
+
+    @classmethod
+    async def view(cls, parsed_request, *args, **kwargs):
+        if parsed_request[0] not in GetHistory.allowed_methods:
+            return 'Wrong method.'
+        chat_id = parsed_request[2]
+        if chat_id != 'public' and chat_id not in sessions.registry:
+            return {'status': 'chat not found',
+                    'chat_id': chat_id,
+                    }
+        # before and after are timestamps, '-' leaves that end open.
+        before, after = [
+            parsed_request[index]
+            if len(parsed_request) > index and parsed_request[index] != '-'
+            else None for index in (3, 4)]
+        try:
+            limit = min(max(int(parsed_request[5]), 1), mm.HISTORY_LIMIT) \
+                if len(parsed_request) > 5 else mm.HISTORY_LIMIT
+            cursor = parsed_request[6] if len(parsed_request) > 6 else None
+            messages, cursor = await mm.call(
+                mm.get_history_page, chat_id, before, after, limit, cursor)
+        except ValueError as e:
+            return {'status': f'{e}',
+                    'chat_id': chat_id,
+                    }
+        response = {'status': 'history received',
+                    'chat_id': chat_id,
+                    'messages': messages
+                    }
+        if cursor:
+            response['cursor'] = cursor
+        return response
+
+
+class GetSearch:
+    allowed_methods = ['GET']
+
+    @classmethod
+    async def view(cls, parsed_request, *args, **kwargs):
+        if parsed_request[0] not in GetSearch.allowed_methods:
+            return 'Wrong method.'
+        if len(parsed_request) < 4:
+            return 'Invalid request format.'
+        chat_id = parsed_request[2]
+        if chat_id != 'public' and chat_id not in sessions.registry:
+            return {'status': 'chat not found',
+                    'chat_id': chat_id,
+                    }
+        # Terms of the query are joined with '+'.
+        query = parsed_request[3].replace('+', ' ')
+        try:
+            limit = min(max(int(parsed_request[4]), 1), mm.SEARCH_LIMIT) \
+                if len(parsed_request) > 4 else mm.SEARCH_LIMIT
+        except ValueError as e:
+            return {'status': f'{e}',
+                    'chat_id': chat_id,
+                    }
+        messages = await mm.call(mm.search_messages, chat_id, query, limit)
+        return {'status': 'search results',
+                'chat_id': chat_id,
+                'messages': messages
+                }
+
+
+class GetPing:
+    allowed_methods = ['GET']
+
+    @classmethod
+    async def view(cls, parsed_request, *args, **kwargs):
+        if parsed_request[0] not in GetPing.allowed_methods:
+            return 'Wrong method.'
+        return {'status': 'pong'}
+
+
+class GetMetrics:
+    allowed_methods = ['GET']
+
+    @classmethod
+    async def view(cls, parsed_request, *args, **kwargs):
+        if parsed_request[0] not in GetMetrics.allowed_methods:
+            return 'Wrong method.'
+        if len(parsed_request) > 2 and parsed_request[2] == 'text':
+            return metrics.render_text()
+        return metrics.snapshot()
 
 
 urls = {
@@ -140,4 +280,22 @@ urls = {
         '/send': PostSend.view,
         '/read': PostMarkRead.view,
         '/unread': GetUnread.view,
+        '/unread_counts': GetUnreadCounts.view,
+        '/history': GetHistory.view,
+        '/search': GetSearch.view,
+        '/ping': GetPing.view,
+        '/metrics': GetMetrics.view,
+        }
+
+# Per connection and per user; routes without a limit are always admitted.
+# Routes reading chats are shed while the server is overloaded.
+limits = {
+        '/connect': Limit(rate=1, burst=5),
+        '/status': Limit(rate=20, burst=40),
+        '/send': Limit(rate=20, burst=40),
+        '/read': Limit(rate=50, burst=100, responds=False),
+        '/unread': Limit(rate=5, burst=10, shed=True),
+        '/unread_counts': Limit(rate=20, burst=40),
+        '/history': Limit(rate=10, burst=20, shed=True),
+        '/search': Limit(rate=5, burst=10, shed=True),
         }